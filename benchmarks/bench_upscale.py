@@ -0,0 +1,298 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# UPSCALE BENCHMARKS
+#---------------------------------------------------------------------------------------------------------------------#
+# Times functions_upscale and CR Apply Multi Upscale on CPU without ComfyUI or a GPU. The comfy modules and
+# folder_paths are replaced by small stubs, and upscale models are synthetic ESRGAN-shaped networks.
+#
+#   python benchmarks/bench_upscale.py --output bench_upscale.json
+#   python benchmarks/bench_upscale.py --quick --repeat 9 --baseline benchmarks/baseline_upscale.json
+#
+# With --baseline, any case slower than the baseline by more than --threshold is reported as a regression and
+# the script exits with status 1. Timings are machine specific, so keep one baseline per benchmark machine.
+#
+# benchmarks/baseline_upscale.json holds the --quick matrix with --repeat 9, recorded on a single core x86_64 host
+# with torch 2.14 (see its "meta"). Compare with the same flags, as cases missing from the baseline are skipped.
+# On a new benchmark machine, or after a change that is meant to alter timings, refresh it from a clean tree with
+#
+#   python benchmarks/bench_upscale.py --quick --repeat 9 --update-baseline benchmarks/baseline_upscale.json
+#
+# and commit the new file on its own. On shared hosts run to run noise reaches 25% even for cases over 100ms, so
+# use a larger --threshold, such as 0.5, there.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+PACKAGE_NAME = "comfyroll_bench"
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Synthetic models
+#---------------------------------------------------------------------------------------------------------------------#
+# Same layout as ESRGAN: conv_first, a trunk of residual blocks, nearest 2x upsample convs and conv_last.
+
+class SyntheticESRGAN(nn.Module):
+
+    def __init__(self, num_feat=32, num_block=4, scale=4, in_nc=3, out_nc=3):
+        super().__init__()
+        self.scale = scale
+        self.in_nc = in_nc
+        self.conv_first = nn.Conv2d(in_nc, num_feat, 3, 1, 1)
+        self.body = nn.ModuleList([nn.Sequential(nn.Conv2d(num_feat, num_feat, 3, 1, 1),
+                                                 nn.LeakyReLU(0.2, inplace=True),
+                                                 nn.Conv2d(num_feat, num_feat, 3, 1, 1)) for _ in range(num_block)])
+        self.conv_body = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.upconvs = nn.ModuleList([nn.Conv2d(num_feat, num_feat, 3, 1, 1) for _ in range(max(scale.bit_length() - 1, 0))])
+        self.conv_last = nn.Conv2d(num_feat, out_nc, 3, 1, 1)
+
+    def forward(self, x):
+        feat = self.conv_first(x)
+        body = feat
+        for block in self.body:
+            body = body + block(body)
+        feat = feat + self.conv_body(body)
+        for upconv in self.upconvs:
+            feat = F.leaky_relu(upconv(F.interpolate(feat, scale_factor=2, mode="nearest")), 0.2)
+        return self.conv_last(feat)
+
+def save_synthetic_model(path, num_feat, num_block, scale):
+    torch.manual_seed(0)
+    model = SyntheticESRGAN(num_feat, num_block, scale)
+    sd = model.state_dict()
+    sd["bench.config"] = torch.tensor([num_feat, num_block, scale])
+    torch.save(sd, path)
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Stub modules
+#---------------------------------------------------------------------------------------------------------------------#
+
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", pbar=None):
+    # Copy of comfy.utils.tiled_scale
+    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
+    for b in range(samples.shape[0]):
+        s = samples[b:b+1]
+        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
+        out_div = torch.zeros_like(out)
+        for y in range(0, s.shape[2], tile_y - overlap):
+            for x in range(0, s.shape[3], tile_x - overlap):
+                s_in = s[:,:,y:y+tile_y,x:x+tile_x]
+                with torch.inference_mode():
+                    ps = function(s_in).to(output_device)
+                mask = torch.ones_like(ps)
+                feather = round(overlap * upscale_amount)
+                for t in range(feather):
+                    mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
+                    mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
+                    mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
+                    mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
+                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
+                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
+        output[b:b+1] = out/out_div
+    return output
+
+def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
+    return ((width + tile_x - overlap - 1) // (tile_x - overlap)) * ((height + tile_y - overlap - 1) // (tile_y - overlap))
+
+class ProgressBar:
+    def __init__(self, total):
+        self.total = total
+
+    def update(self, value):
+        pass
+
+def load_state_dict(sd):
+    num_feat, num_block, scale = [int(v) for v in sd.pop("bench.config")]
+    model = SyntheticESRGAN(num_feat, num_block, scale)
+    model.load_state_dict(sd)
+    return model
+
+def install_stubs(model_dir):
+    comfy = types.ModuleType("comfy")
+    comfy_utils = types.ModuleType("comfy.utils")
+    comfy_utils.load_torch_file = lambda path, safe_load=False: torch.load(path)
+    comfy_utils.state_dict_prefix_replace = lambda sd, replace: sd
+    comfy_utils.tiled_scale = tiled_scale
+    comfy_utils.get_tiled_scale_steps = get_tiled_scale_steps
+    comfy_utils.ProgressBar = ProgressBar
+
+    model_management = types.ModuleType("comfy.model_management")
+    model_management.get_torch_device = lambda: torch.device("cpu")
+    model_management.get_free_memory = lambda device=None: 8 * 1024 ** 3
+    model_management.OOM_EXCEPTION = MemoryError
+    comfy.utils = comfy_utils
+    comfy.model_management = model_management
+
+    comfy_extras = types.ModuleType("comfy_extras")
+    chainner_models = types.ModuleType("comfy_extras.chainner_models")
+    model_loading = types.ModuleType("comfy_extras.chainner_models.model_loading")
+    model_loading.load_state_dict = load_state_dict
+    chainner_models.model_loading = model_loading
+    comfy_extras.chainner_models = chainner_models
+
+    folder_paths = types.ModuleType("folder_paths")
+    folder_paths.get_full_path = lambda folder_name, filename: os.path.join(model_dir, filename)
+    folder_paths.get_filename_list = lambda folder_name: sorted(os.listdir(model_dir))
+    folder_paths.get_temp_directory = lambda: os.path.join(model_dir, "temp")
+
+    modules = {"comfy": comfy, "comfy.utils": comfy_utils, "comfy.model_management": model_management,
+               "comfy_extras": comfy_extras, "comfy_extras.chainner_models": chainner_models,
+               "comfy_extras.chainner_models.model_loading": model_loading, "folder_paths": folder_paths}
+
+    # safetensors is only needed for the result cache, which is not benchmarked here
+    try:
+        import safetensors.torch
+    except ImportError:
+        safetensors = types.ModuleType("safetensors")
+        safetensors.torch = types.ModuleType("safetensors.torch")
+        modules["safetensors"] = safetensors
+        modules["safetensors.torch"] = safetensors.torch
+
+    sys.modules.update(modules)
+
+    # Import the node package without running its __init__, which loads every node
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [REPO_DIR]
+    sys.modules[PACKAGE_NAME] = package
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Benchmarks
+#---------------------------------------------------------------------------------------------------------------------#
+
+def time_call(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def run_benchmarks(model_dir, quick=False, repeat=3):
+    import importlib
+    fu = importlib.import_module(f"{PACKAGE_NAME}.nodes.functions_upscale")
+    nu = importlib.import_module(f"{PACKAGE_NAME}.nodes.nodes_upscale")
+
+    results = {}
+    batch_sizes = [1, 4] if quick else [1, 4, 16]
+    resolutions = [64, 128] if quick else [64, 128, 256]
+    resample_modes = ["lanczos", "bicubic", "bilinear", "nearest"]
+    supersample_modes = ["false", "true"] if quick else ["false", "true", "legacy"]
+
+    # load_model, first load from disk and then from the cache
+    fu.upscale_model_cache.clear()
+    results["load_model/cold"] = time_call(lambda: (fu.upscale_model_cache.clear(), fu.load_model("bench_4x.pth")), repeat)
+    results["load_model/cached"] = time_call(lambda: fu.load_model("bench_4x.pth"), repeat)
+    model_4x = fu.load_model("bench_4x.pth")
+
+    # upscale_with_model, serial and threaded tiles
+    for batch_size in batch_sizes:
+        for resolution in resolutions:
+            image = torch.rand((batch_size, resolution, resolution, 3))
+            name = f"upscale_with_model/b{batch_size}/{resolution}px"
+            results[name + "/serial"] = time_call(lambda: fu.upscale_with_model(model_4x, image), repeat)
+            results[name + "/threads4"] = time_call(lambda: fu.upscale_with_model(model_4x, image, cpu_workers=4), repeat)
+
+    # apply_resize_image on the PIL engine and resize_image_batch on the torch engine
+    for batch_size in batch_sizes:
+        for resolution in resolutions:
+            image = torch.rand((batch_size, resolution * 4, resolution * 4, 3))
+            for resample in resample_modes:
+                for supersample in supersample_modes:
+                    name = f"resize/b{batch_size}/{resolution * 4}px/{resample}/supersample_{supersample}"
+                    results[name + "/pil"] = time_call(lambda: fu.apply_resize_batch(image, resolution, resolution, 8, "rescale", supersample, 2, 1024, resample, "pil"), repeat)
+                    results[name + "/torch"] = time_call(lambda: fu.apply_resize_batch(image, resolution, resolution, 8, "rescale", supersample, 2, 1024, resample, "torch"), repeat)
+
+    # CR Apply Multi Upscale with a two stage stack, whole batch and chunked
+    node = nu.CR_ApplyMultiUpscale()
+    upscale_stack = [("bench_4x.pth", 2.0), ("bench_2x.pth", 3.0)]
+    for batch_size in batch_sizes:
+        image = torch.rand((batch_size, resolutions[0], resolutions[0], 3))
+        name = f"apply_multi_upscale/b{batch_size}/{resolutions[0]}px"
+        for resize_engine in ["pil", "torch"]:
+            results[f"{name}/{resize_engine}"] = time_call(lambda: node.apply(image, "lanczos", "false", 8, upscale_stack, resize_engine=resize_engine), repeat)
+        results[f"{name}/torch/chunk2"] = time_call(lambda: node.apply(image, "lanczos", "false", 8, upscale_stack, resize_engine="torch", chunk_size=2), repeat)
+
+    return results
+
+def compare_to_baseline(results, baseline, threshold):
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        base_seconds = baseline.get(name)
+        if base_seconds is None or base_seconds <= 0:
+            continue
+        ratio = seconds / base_seconds
+        if ratio > 1.0 + threshold:
+            regressions.append({"name": name, "seconds": seconds, "baseline": base_seconds, "ratio": ratio})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU benchmarks for the Comfyroll upscale functions")
+    parser.add_argument("--output", default="bench_upscale.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--update-baseline", help="write the results as a new baseline to this path")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown against the baseline, 0.2 is 20%%")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the median is reported")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument("--quick", action="store_true", help="run a smaller matrix")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        save_synthetic_model(os.path.join(model_dir, "bench_4x.pth"), 32, 4, 4)
+        save_synthetic_model(os.path.join(model_dir, "bench_2x.pth"), 32, 4, 2)
+        install_stubs(model_dir)
+        results = run_benchmarks(model_dir, args.quick, args.repeat)
+
+    report = {"meta": {"python": platform.python_version(),
+                       "torch": torch.__version__,
+                       "machine": platform.machine(),
+                       "processor": platform.processor(),
+                       "threads": torch.get_num_threads(),
+                       "quick": args.quick,
+                       "repeat": args.repeat,
+                      },
+              "results": results,
+             }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        report["regressions"] = regressions
+        for r in regressions:
+            print(f"[Warning] Regression: {r['name']} {r['seconds']:.4f}s vs {r['baseline']:.4f}s ({r['ratio']:.2f}x)")
+        if regressions:
+            exit_code = 1
+        else:
+            print(f"[Info] No regressions against {args.baseline}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[Info] Wrote {len(results)} results to {args.output}")
+
+    if args.update_baseline:
+        with open(args.update_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[Info] Updated baseline {args.update_baseline}")
+
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -74,4 +74,39 @@ iso_sizes = {
     "C9 - 472x673": (472, 673),
     "C10 - 331x472": (331, 472),
 }          
-          
\ No newline at end of file
+          
+#---------------------------------------------------------------------------------------------------------------------#
+# Cache budgets for process-wide model caches, in bytes
+UPSCALE_MODEL_CACHE_BYTES = 2 * 1024 ** 3
+UPSCALE_RESULT_CACHE_BYTES = 1 * 1024 ** 3
+UPSCALE_RESULT_DISK_CACHE_BYTES = 10 * 1024 ** 3
+LORA_CACHE_BYTES = 4 * 1024 ** 3
+LORA_DELTA_CACHE_BYTES = 4 * 1024 ** 3
+CONTROLNET_CACHE_BYTES = 4 * 1024 ** 3
+
+# Checkpoints kept loaded across nodes, as a count and a byte budget
+CHECKPOINT_CACHE_ITEMS = 3
+CHECKPOINT_CACHE_BYTES = 24 * 1024 ** 3
+
+# Patched model and clip pairs kept for fused LoRA stacks, as a count and a byte budget for their patch tensors
+FUSED_LORA_STACK_CACHE_ITEMS = 8
+FUSED_LORA_STACK_CACHE_BYTES = 4 * 1024 ** 3
+
+# Threads and in-flight bytes for reading LoRA stack files ahead of use, 0 threads disables prefetch
+LORA_PREFETCH_WORKERS = 4
+LORA_PREFETCH_MAX_BYTES = 2 * 1024 ** 3
+
+# Per node state kept by the random LoRA nodes, as a maximum entry count and seconds unused before expiry
+RANDOM_LORA_STATE_ITEMS = 10000
+RANDOM_LORA_STATE_TTL = 24 * 60 * 60
+
+# Encoder threads and queued images for the CR Image Output background writer
+IMAGE_WRITER_WORKERS = 4
+IMAGE_WRITER_QUEUE_SIZE = 32
+
+# Directory for cached upscale results, None uses a folder in the ComfyUI models directory
+UPSCALE_RESULT_CACHE_DIR = None
+
+# Directory and byte budget for merged models cached by recipe, None uses a folder in the ComfyUI models directory
+MODEL_MERGE_CACHE_DIR = None
+MODEL_MERGE_CACHE_BYTES = 50 * 1024 ** 3
@@ -121,6 +121,7 @@ NODE_CLASS_MAPPINGS = {
     "CR Multi Upscale Stack": CR_MultiUpscaleStack,
     "CR Upscale Image": CR_UpscaleImage,
     "CR Apply Multi Upscale": CR_ApplyMultiUpscale,
+    "CR Upscale Stack Planner": CR_UpscaleStackPlanner,
     ### XY Grid Nodes    
     "CR XY List": CR_XYList,  
     "CR XY Interpolate": CR_XYInterpolate,   
@@ -368,6 +369,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "CR Multi Upscale Stack": "🔍 CR Multi Upscale Stack",
     "CR Upscale Image": "🔍 CR Upscale Image",
     "CR Apply Multi Upscale": "🔍 CR Apply Multi Upscale",
+    "CR Upscale Stack Planner": "🔍 CR Upscale Stack Planner",
     ### XY Grid Nodes    
     "CR XY List": "📉 CR XY List",  
     "CR XY Interpolate": "📉 CR XY Interpolate", 
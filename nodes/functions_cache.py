@@ -0,0 +1,298 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# CACHE FUNCTIONS
+#---------------------------------------------------------------------------------------------------------------------#
+# Process-wide LRU caches for models loaded from disk. Entries are keyed by the resolved file path plus the file
+# mtime, so replacing a file on disk invalidates its cached copy on the next lookup. DiskCache keeps computed
+# results as files in a directory, under its own byte budget.
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+# Size of a cached object in bytes, counting tensors, modules and containers of them
+def object_nbytes(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.nelement() * obj.element_size()
+    if isinstance(obj, torch.nn.Module):
+        params = sum(object_nbytes(p) for p in obj.parameters())
+        buffers = sum(object_nbytes(b) for b in obj.buffers())
+        return params + buffers
+    if isinstance(obj, dict):
+        return sum(object_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(object_nbytes(v) for v in obj)
+    return 0
+
+# Resolved path and mtime of a file, used as the cache key
+def file_cache_key(path):
+    real_path = os.path.realpath(path)
+    return (real_path, os.path.getmtime(real_path))
+
+
+# LRU cache bounded by bytes and/or item count. With ttl set, entries unused for ttl seconds also expire.
+# Pinned entries are still counted against the budget but are never evicted until every pin is released.
+class LRUCache:
+
+    def __init__(self, name, max_bytes, max_items=None, sizeof=object_nbytes, ttl=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.pins = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self.lock:
+            self._expire()
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._expire()
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            value, nbytes, last_used = self.entries[key]
+            self.entries[key] = (value, nbytes, time.monotonic())
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            # Objects larger than the whole budget are returned uncached
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return value
+            self.entries[key] = (value, nbytes, time.monotonic())
+            self.total_bytes += nbytes
+            self._expire()
+            self._evict()
+        return value
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pins.clear()
+            self.total_bytes = 0
+
+    def pin(self, key):
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            else:
+                self.pins.pop(key, None)
+            self._evict()
+
+    def pinned_bytes(self):
+        with self.lock:
+            return sum(self.entries[k][1] for k in self.pins if k in self.entries)
+
+    def set_budget(self, max_bytes=None, max_items=None):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.max_items = max_items
+            self._evict()
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, None)
+        if value is not None:
+            return value
+        value = loader()
+        with self.lock:
+            self.loads += 1
+        return self.put(key, value)
+
+    # Load a file through the cache, dropping entries for older versions of the same file. Keys may carry extra
+    # fields after (path, mtime), such as the parts of a partly loaded checkpoint, which are kept for this version.
+    def get_or_load_file(self, path, loader):
+        key = file_cache_key(path)
+        with self.lock:
+            for stale in [k for k in self.entries if k[0] == key[0] and k[1] != key[1]]:
+                self._remove(stale)
+        return self.get_or_load(key, lambda: loader(key[0]))
+
+    def stats(self):
+        with self.lock:
+            return {"name": self.name,
+                    "entries": len(self.entries),
+                    "bytes": self.total_bytes,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "loads": self.loads,
+                    "evictions": self.evictions,
+                    "pinned": len(self.pins),
+                   }
+
+    def _remove(self, key):
+        value, nbytes, last_used = self.entries.pop(key)
+        self.total_bytes -= nbytes
+
+    # Entries are in order of last use, so expired ones are at the front
+    def _expire(self):
+        if self.ttl is None:
+            return
+        cutoff = time.monotonic() - self.ttl
+        for key, (value, nbytes, last_used) in list(self.entries.items()):
+            if last_used > cutoff:
+                break
+            if key in self.pins:
+                continue
+            self._remove(key)
+            self.evictions += 1
+
+    def _evict(self):
+        while self._over_budget():
+            key = next((k for k in self.entries if k not in self.pins), None)
+            if key is None:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _over_budget(self):
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        if self.max_items is not None and len(self.entries) > self.max_items:
+            return True
+        return False
+
+# Content hash of a tensor, including its shape and dtype. A CPU tensor's bytes are hashed in place without a copy.
+# A tensor on another device is reduced there to a few position-weighted sums of its 32-bit words, so only the sums
+# are copied to the host. Any change to a single word changes every sum, but unlike the CPU path this is a checksum
+# for cache keys, not a cryptographic hash.
+TENSOR_HASH_CHUNK = 16 * 1024 ** 2
+TENSOR_HASH_WEIGHTS = ((1, 0), (48271, 11), (69621, 7))
+
+def tensor_hash(tensor):
+    data = tensor.detach().contiguous().reshape(-1)
+    words = data.view(torch.uint8)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((tuple(tensor.shape), str(tensor.dtype), tensor.device.type == "cpu")).encode('utf-8'))
+
+    if tensor.device.type == "cpu":
+        h.update(memoryview(words.numpy()))
+        return h.hexdigest()
+
+    if words.nelement() % 4 == 0:
+        words = words.view(torch.int32)
+    # int64 products and sums wrap on overflow, which is the same on every device
+    sums = [0] * len(TENSOR_HASH_WEIGHTS)
+    for start in range(0, words.nelement(), TENSOR_HASH_CHUNK):
+        chunk = words[start:start + TENSOR_HASH_CHUNK].to(torch.int64)
+        positions = torch.arange(start, start + chunk.nelement(), device=chunk.device, dtype=torch.int64)
+        for i, (a, b) in enumerate(TENSOR_HASH_WEIGHTS):
+            sums[i] += int((chunk * (positions * a + b)).sum())
+    h.update(repr(sums).encode('utf-8'))
+    return h.hexdigest()
+
+
+# Files in a directory named by key, evicted oldest-used first when over the byte budget
+class DiskCache:
+
+    def __init__(self, name, directory, max_bytes, suffix=".safetensors"):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    # Path of the cached file for key, or None if it is not cached
+    def get_path(self, key):
+        path = self.path(key)
+        with self.lock:
+            if not os.path.isfile(path):
+                self.misses += 1
+                return None
+            # The mtime tracks last use for eviction
+            os.utime(path)
+            self.hits += 1
+            return path
+
+    # Write a file for key through writer(path), replacing it atomically
+    def put_file(self, key, writer):
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            writer(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            total_bytes = sum(f[1] for f in files)
+            for mtime, size, path in sorted(files):
+                if self.max_bytes is None or total_bytes <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"name": self.name,
+                    "directory": self.directory,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                   }
@@ -0,0 +1,219 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# CHECKPOINT FUNCTIONS
+#---------------------------------------------------------------------------------------------------------------------#
+
+import os
+import inspect
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import comfy.sd
+import comfy.utils
+import folder_paths
+from safetensors import safe_open
+from .functions_cache import LRUCache, file_cache_key, object_nbytes
+from ..config import CHECKPOINT_CACHE_ITEMS, CHECKPOINT_CACHE_BYTES
+
+# Checkpoint key prefixes for each component
+UNET_PREFIX = "model.diffusion_model."
+CLIP_PREFIXES = ("cond_stage_model.", "conditioner.", "text_encoders.")
+VAE_PREFIXES = ("first_stage_model.", "vae.")
+
+SAFETENSORS_DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+                      "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8,
+                      "BOOL": torch.bool}
+
+# Size of a loaded (MODEL, CLIP, VAE) in bytes, from the torch modules each one wraps
+def checkpoint_nbytes(checkpoint):
+    model, clip, vae = checkpoint
+    nbytes = 0
+    if model is not None:
+        nbytes += object_nbytes(model.model)
+    if clip is not None:
+        nbytes += object_nbytes(clip.cond_stage_model)
+    if vae is not None:
+        nbytes += object_nbytes(vae.first_stage_model)
+    return nbytes
+
+# (MODEL, CLIP, VAE) shared by all checkpoint nodes, keyed by resolved path and file mtime
+checkpoint_cache = LRUCache("checkpoints", CHECKPOINT_CACHE_BYTES, max_items=CHECKPOINT_CACHE_ITEMS, sizeof=checkpoint_nbytes)
+
+# Cache key currently pinned by each owner, usually a node instance, keyed by id(owner). A finalizer on the owner
+# releases its pin when it is freed, which also removes the id before it can be reused.
+checkpoint_refs = {}
+checkpoint_refs_lock = threading.RLock()
+
+def _load_checkpoint_file(path):
+    embedding_directory = folder_paths.get_folder_paths("embeddings")
+    # A state dict read ahead by a preload is built into models here, on the caller's thread
+    state_dict = preloaded_checkpoint_cache.get(file_cache_key(path))
+    if state_dict is not None:
+        preloaded_checkpoint_cache.remove(file_cache_key(path))
+        out = comfy.sd.load_state_dict_guess_config(state_dict, output_vae=True, output_clip=True, embedding_directory=embedding_directory)
+        return out[:3]
+    out = comfy.sd.load_checkpoint_guess_config(path, output_vae=True, output_clip=True, embedding_directory=embedding_directory)
+    return out[:3]
+
+def load_checkpoint(ckpt_name, owner=None):
+    ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
+
+    # Wait for a preload of this file rather than reading it a second time
+    with checkpoint_preload_lock:
+        future = checkpoint_preload_futures.get(os.path.realpath(ckpt_path))
+    if future is not None:
+        future.result()
+
+    loads = checkpoint_cache.loads
+    checkpoint = checkpoint_cache.get_or_load_file(ckpt_path, _load_checkpoint_file)
+    if checkpoint_cache.loads != loads:
+        print(f"[Info] Loaded checkpoint {ckpt_name}")
+    if owner is not None:
+        hold_checkpoint(owner, ckpt_path)
+    return checkpoint
+
+# Keep an owner's current checkpoint loaded, releasing the one it held before.
+# An owner holds one checkpoint at a time, so switching models frees the old one for eviction.
+def hold_checkpoint(owner, ckpt_path):
+    key = file_cache_key(ckpt_path)
+    with checkpoint_refs_lock:
+        previous = checkpoint_refs.get(id(owner))
+        if previous == key:
+            return
+        checkpoint_cache.pin(key)
+        if previous is None:
+            weakref.finalize(owner, _release_checkpoint_ref, id(owner))
+        checkpoint_refs[id(owner)] = key
+    if previous is not None:
+        checkpoint_cache.unpin(previous)
+
+def _release_checkpoint_ref(owner_id):
+    with checkpoint_refs_lock:
+        previous = checkpoint_refs.pop(owner_id, None)
+    if previous is not None:
+        checkpoint_cache.unpin(previous)
+
+def release_checkpoint(owner):
+    _release_checkpoint_ref(id(owner))
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Partial checkpoint loading
+#---------------------------------------------------------------------------------------------------------------------#
+# Reads only the UNet and/or CLIP keys of a safetensors checkpoint and never the VAE. When the UNet is not wanted its
+# keys are passed as meta tensors, which carry the shapes ComfyUI needs to detect the model type without any data.
+
+def _read_checkpoint_parts(path, output_model, output_clip, meta_unet):
+    state_dict = {}
+    bytes_read = 0
+    bytes_skipped = 0
+    with safe_open(path, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            is_unet = key.startswith(UNET_PREFIX)
+            if key.startswith(VAE_PREFIXES) or (key.startswith(CLIP_PREFIXES) and not output_clip) or (is_unet and not output_model):
+                tensor_slice = f.get_slice(key)
+                meta = torch.empty(tensor_slice.get_shape(), dtype=SAFETENSORS_DTYPES.get(tensor_slice.get_dtype(), torch.float32), device="meta")
+                bytes_skipped += meta.nelement() * meta.element_size()
+                if is_unet and meta_unet:
+                    state_dict[key] = meta
+                continue
+            tensor = f.get_tensor(key)
+            bytes_read += tensor.nelement() * tensor.element_size()
+            state_dict[key] = tensor
+    return state_dict, bytes_read, bytes_skipped
+
+def _load_checkpoint_parts(path, output_model, output_clip):
+    load_state_dict = comfy.sd.load_state_dict_guess_config
+    # ComfyUI versions without output_model always build the model, so they need the real UNet weights
+    meta_unet = "output_model" in inspect.signature(load_state_dict).parameters
+    state_dict, bytes_read, bytes_skipped = _read_checkpoint_parts(path, output_model or not meta_unet, output_clip, meta_unet)
+
+    kwargs = {"output_model": output_model} if meta_unet else {}
+    out = load_state_dict(state_dict, output_vae=False, output_clip=output_clip,
+                          embedding_directory=folder_paths.get_folder_paths("embeddings"), **kwargs)
+    model = out[0] if output_model else None
+    clip = out[1] if output_clip else None
+    return (model, clip, None), {"bytes_read": bytes_read, "bytes_skipped": bytes_skipped}
+
+# Load only the parts of a checkpoint a caller uses, returning (MODEL or None, CLIP or None, load info).
+# A full copy already in the checkpoint cache is used as is.
+def load_checkpoint_parts(ckpt_name, output_model=True, output_clip=True):
+    ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
+    key = file_cache_key(ckpt_path)
+
+    checkpoint = checkpoint_cache.get(key)
+    if checkpoint is not None:
+        return checkpoint[0], checkpoint[1], {"bytes_read": 0, "bytes_skipped": 0}
+
+    if not ckpt_path.endswith(".safetensors") or not hasattr(comfy.sd, "load_state_dict_guess_config"):
+        checkpoint = load_checkpoint(ckpt_name)
+        return checkpoint[0], checkpoint[1], {"bytes_read": os.path.getsize(key[0]), "bytes_skipped": 0}
+
+    parts_key = key + ((output_model, output_clip),)
+    checkpoint = checkpoint_cache.get(parts_key)
+    if checkpoint is not None:
+        return checkpoint[0], checkpoint[1], {"bytes_read": 0, "bytes_skipped": 0}
+
+    checkpoint, info = _load_checkpoint_parts(key[0], output_model, output_clip)
+    checkpoint_cache.put(parts_key, checkpoint)
+    parts = " and ".join(part for part, wanted in (("UNet", output_model), ("CLIP", output_clip)) if wanted)
+    print(f"[Info] Loaded {parts} of checkpoint {ckpt_name}, skipped {info['bytes_skipped'] / 1024 ** 3:.2f} GB")
+    return checkpoint[0], checkpoint[1], info
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Checkpoint preloading
+#---------------------------------------------------------------------------------------------------------------------#
+# Scheduled and cycled model nodes know which checkpoint comes next, so they can read its file on a background thread
+# a few frames early. Only the state dict is read there; the MODEL, CLIP and VAE are built from it by the next
+# load_checkpoint on the caller's thread. Preloads run one at a time and only start when the file fits in the cache
+# budget left over by pinned checkpoints and other preloaded files, so a preload never evicts a model that is in use.
+
+# State dicts read by preloads, keyed by resolved path and file mtime. Only the next scheduled model is preloaded,
+# so one is kept and an unused one is dropped by the next preload.
+preloaded_checkpoint_cache = LRUCache("preloaded checkpoints", CHECKPOINT_CACHE_BYTES, max_items=1)
+
+checkpoint_preload_lock = threading.Lock()
+checkpoint_preload_futures = {}
+checkpoint_preload_executor = None
+
+def _preload_checkpoint_file(key, ckpt_name):
+    try:
+        preloaded_checkpoint_cache.put(key, comfy.utils.load_torch_file(key[0], safe_load=True))
+        print(f"[Info] Preloaded checkpoint {ckpt_name}")
+    except Exception as e:
+        print(f"[Warning] Preloading checkpoint {ckpt_name} failed: {e}")
+    finally:
+        with checkpoint_preload_lock:
+            checkpoint_preload_futures.pop(key[0], None)
+
+def preload_checkpoint(ckpt_name):
+    global checkpoint_preload_executor
+    if ckpt_name is None or ckpt_name == "None":
+        return False
+    # ComfyUI versions that can only build a checkpoint from a file have nothing to read ahead
+    if not hasattr(comfy.sd, "load_state_dict_guess_config"):
+        return False
+    ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
+    if ckpt_path is None:
+        return False
+    key = file_cache_key(ckpt_path)
+
+    with checkpoint_preload_lock:
+        if key in checkpoint_cache or key in preloaded_checkpoint_cache or key[0] in checkpoint_preload_futures:
+            return True
+        # The file size only approximates the loaded size, which differs when weights are cast on load, so this
+        # check is a rough guard rather than an exact budget
+        if checkpoint_cache.max_bytes is not None:
+            headroom = checkpoint_cache.max_bytes - checkpoint_cache.pinned_bytes() - preloaded_checkpoint_cache.total_bytes
+            if os.path.getsize(key[0]) > headroom:
+                return False
+        if checkpoint_cache.max_items is not None and len(checkpoint_cache.pins) >= checkpoint_cache.max_items:
+            return False
+        if checkpoint_preload_executor is None:
+            checkpoint_preload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cr_checkpoint_preload")
+        checkpoint_preload_futures[key[0]] = checkpoint_preload_executor.submit(_preload_checkpoint_file, key, ckpt_name)
+    return True
@@ -0,0 +1,125 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# CONTROLNET FUNCTIONS
+#---------------------------------------------------------------------------------------------------------------------#
+
+import time
+import comfy.controlnet
+import comfy.utils
+import folder_paths
+from .functions_cache import LRUCache, object_nbytes
+from ..config import CONTROLNET_CACHE_BYTES
+
+# Size of a loaded ControlNet, T2I adapter or control LoRA in bytes
+def controlnet_nbytes(control_net):
+    for attr in ("control_model", "t2i_model", "control_weights"):
+        value = getattr(control_net, attr, None)
+        if value is not None:
+            return object_nbytes(value)
+    return 0
+
+# ControlNets shared by all ControlNet nodes, keyed by resolved path and file mtime.
+# Applying a ControlNet copies it before setting the hint, so one loaded object can be shared.
+controlnet_cache = LRUCache("controlnets", CONTROLNET_CACHE_BYTES, sizeof=controlnet_nbytes)
+
+def load_controlnet(controlnet_name):
+    controlnet_path = folder_paths.get_full_path("controlnet", controlnet_name)
+    loads = controlnet_cache.loads
+    control_net = controlnet_cache.get_or_load_file(controlnet_path, comfy.controlnet.load_controlnet)
+    if controlnet_cache.loads != loads:
+        stats = controlnet_cache.stats()
+        print(f"[Info] Loaded ControlNet {controlnet_name}. {stats['loads']} loads, {stats['hits']} cache hits")
+    return control_net
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Batched ControlNet application
+#---------------------------------------------------------------------------------------------------------------------#
+# Applying a stack one ControlNet at a time copies every conditioning entry once per ControlNet. The batched path
+# builds the whole chain of ControlNets once for each distinct previous control and attaches it in one pass.
+# With the latent size known, each hint is resized once per image tensor and size, moved to the ControlNet's device
+# and set as its prepared hint, so get_control finds it at the right size and skips its own resize on the first
+# sampling run. The ControlNet's preprocess_image is applied after the resize, as get_control does. ControlNets
+# that prepare their hint in other ways, such as VAE encoding it, are left to do so.
+
+# The size get_control resizes a ControlNet's hint to, or None if the hint cannot be prepared ahead for it
+def prepared_hint_size(controlnet, latent_size):
+    if latent_size is None or type(controlnet) is not comfy.controlnet.ControlNet:
+        return None
+    if getattr(controlnet, "control_model", None) is None or getattr(controlnet, "vae", None) is not None:
+        return None
+    if getattr(controlnet, "latent_format", None) is not None or getattr(controlnet, "extra_concat_orig", None):
+        return None
+    compression_ratio = getattr(controlnet, "compression_ratio", None)
+    if compression_ratio is None:
+        return None
+    return latent_size[0] * compression_ratio, latent_size[1] * compression_ratio
+
+# The dtype get_control casts a ControlNet's hint to
+def hint_dtype(controlnet):
+    return getattr(controlnet, "manual_cast_dtype", None) or controlnet.control_model.dtype
+
+def prepare_hint(hint, height, width, controlnet):
+    if hint.shape[2] != height or hint.shape[3] != width:
+        hint = comfy.utils.common_upscale(hint, width, height, getattr(controlnet, "upscale_algorithm", "nearest-exact"), "center")
+    preprocess_image = getattr(controlnet, "preprocess_image", None)
+    if preprocess_image is not None:
+        hint = preprocess_image(hint)
+    return hint.to(device=controlnet.device, dtype=hint_dtype(controlnet))
+
+# latent_size is the (height, width) of the latent being sampled, or None to leave every resize to sampling time
+def apply_controlnet_stack_batched(positive, negative, controlnet_stack, latent_size=None):
+    stack = [entry for entry in controlnet_stack if entry[2] != 0]
+    stats = {"controlnets": len(stack), "hints_prepared": 0, "hints_reused": 0, "prepare_seconds": 0.0}
+    if not stack:
+        return positive, negative, stats
+
+    # Hints are shared by tensor identity, the stack nodes pass the same image object to each ControlNet using it
+    hints = {}
+    prepared_stack = []
+    for controlnet, image, strength, start_percent, end_percent in stack:
+        if type(controlnet) == str:
+            controlnet = load_controlnet(controlnet)
+        hint = image.movedim(-1, 1)
+        prepared = None
+        size = prepared_hint_size(controlnet, latent_size)
+        if size is not None:
+            key = (id(image), size, getattr(controlnet, "upscale_algorithm", None), getattr(controlnet, "preprocess_image", None),
+                   controlnet.device, hint_dtype(controlnet))
+            if key in hints:
+                stats["hints_reused"] += 1
+            else:
+                start_time = time.perf_counter()
+                hints[key] = prepare_hint(hint, size[0], size[1], controlnet)
+                stats["prepare_seconds"] += time.perf_counter() - start_time
+                stats["hints_prepared"] += 1
+            prepared = hints[key]
+        prepared_stack.append((controlnet, hint, prepared, strength, (start_percent, end_percent)))
+
+    # One chain per distinct previous control, shared between positive and negative like ControlNetApplyAdvanced
+    chains = {}
+    def chain_for(previous):
+        if previous not in chains:
+            c_net = previous
+            for controlnet, hint, prepared, strength, percent_range in prepared_stack:
+                next_net = controlnet.copy().set_cond_hint(hint, strength, percent_range)
+                if prepared is not None:
+                    next_net.cond_hint = prepared
+                next_net.set_previous_controlnet(c_net)
+                c_net = next_net
+            chains[previous] = c_net
+        return chains[previous]
+
+    out = []
+    for conditioning in [positive, negative]:
+        c = []
+        for t in conditioning:
+            d = t[1].copy()
+            d['control'] = chain_for(d.get('control', None))
+            d['control_apply_to_uncond'] = False
+            c.append([t[0], d])
+        out.append(c)
+    return out[0], out[1], stats
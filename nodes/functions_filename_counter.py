@@ -0,0 +1,101 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# FILENAME COUNTER FUNCTIONS
+#---------------------------------------------------------------------------------------------------------------------#
+# Output nodes number their files with a counter one above the highest already in the folder. Listing a folder
+# with hundreds of thousands of files on every save is slow, so the file names of each folder are listed once and
+# kept in memory, with the highest counter per filename prefix worked out on first use. The folder's mtime is checked
+# on every save and the folder is listed again only when something other than this index has changed it.
+#
+# A counter is reserved by creating its file with O_EXCL, so two writers, in this process or another, can never
+# be given the same file. The caller then writes its image to a temporary file and moves it onto the reservation
+# with replace, or deletes the reservation with release if the write fails. Both keep the index's mtime current
+# when nothing else has changed the folder, so the writer's own changes do not cause another listing.
+
+import os
+import threading
+
+class FilenameCounterIndex:
+
+    def __init__(self):
+        self.directories = {}
+        self.lock = threading.Lock()
+        self.scans = 0
+
+    def _directory(self, directory):
+        directory = os.path.realpath(directory)
+        mtime = os.stat(directory).st_mtime_ns
+        state = self.directories.get(directory)
+        if state is None or state["mtime"] != mtime:
+            state = {"mtime": mtime, "names": set(os.listdir(directory)), "highest": {}}
+            self.directories[directory] = state
+            self.scans += 1
+        return state
+
+    def _highest(self, state, key, parse):
+        if key not in state["highest"]:
+            values = [v for v in map(parse, state["names"]) if v is not None]
+            state["highest"][key] = max(values, default=None)
+        return state["highest"][key]
+
+    # Highest counter in directory for key, or None. parse maps a file name to its counter, or None if the name
+    # does not belong to key.
+    def highest(self, directory, key, parse):
+        with self.lock:
+            return self._highest(self._directory(directory), key, parse)
+
+    # Reserve the next counter for key, creating its file from make_name(counter). Returns the counter.
+    def reserve(self, directory, key, parse, make_name, start=1):
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            state = self._directory(directory)
+            highest = self._highest(state, key, parse)
+            counter = start if highest is None else max(start, highest + 1)
+
+            while True:
+                name = make_name(counter)
+                try:
+                    os.close(os.open(os.path.join(directory, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    counter += 1
+
+            state["names"].add(name)
+            state["highest"][key] = counter
+            # Creating the file changed the mtime, so take it as the new reference
+            state["mtime"] = os.stat(directory).st_mtime_ns
+            return counter
+
+    # Move a finished temporary file onto a reserved name
+    def replace(self, temp_path, path):
+        directory = os.path.realpath(os.path.dirname(path))
+        with self.lock:
+            mtime = os.stat(directory).st_mtime_ns
+            os.replace(temp_path, path)
+            self._changed(directory, mtime)
+
+    # Delete a reservation that will not be written
+    def release(self, path):
+        directory = os.path.realpath(os.path.dirname(path))
+        with self.lock:
+            mtime = os.stat(directory).st_mtime_ns
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            state = self.directories.get(directory)
+            if state is not None:
+                state["names"].discard(os.path.basename(path))
+            self._changed(directory, mtime)
+
+    # Take the mtime after a change of our own as the new reference, unless the folder had already changed
+    def _changed(self, directory, mtime):
+        state = self.directories.get(directory)
+        if state is not None and state["mtime"] == mtime:
+            state["mtime"] = os.stat(directory).st_mtime_ns
+
+filename_counters = FilenameCounterIndex()
@@ -0,0 +1,121 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# IMAGE WRITER FUNCTIONS
+#---------------------------------------------------------------------------------------------------------------------#
+# Encodes and writes images on a pool of background threads. The caller hands over a uint8 array it no longer uses
+# and returns at once. The queue is bounded, so a caller that gets ahead of the disk waits for room. Queued images
+# are flushed when the process exits.
+#
+# Images are saved to file names reserved by the filename counter index. Each image is written to a temporary file
+# in a hidden subfolder and moved onto its reserved name, so a partly written file is never visible. If the write
+# fails the reservation is deleted, so no empty file is left behind.
+
+import os
+import queue
+import atexit
+import threading
+from PIL import Image
+from .functions_filename_counter import filename_counters
+from ..config import IMAGE_WRITER_WORKERS, IMAGE_WRITER_QUEUE_SIZE
+
+# PIL format for each file extension, as temporary file names do not carry it
+IMAGE_FORMATS = {"png": "PNG", "jpg": "JPEG", "webp": "WEBP", "tif": "TIFF"}
+
+# Subfolder of the output folder for temporary files, so writing them leaves the output folder's mtime unchanged
+TEMP_FOLDER = ".cr_tmp"
+
+# Save a PIL image to a reserved path through a temporary file, deleting the reservation if the save fails
+def save_reserved_image(image, path, params):
+    directory, file_name = os.path.split(path)
+    temp_directory = os.path.join(directory, TEMP_FOLDER)
+    os.makedirs(temp_directory, exist_ok=True)
+    temp_path = os.path.join(temp_directory, f"{file_name}.tmp")
+    params = dict(params)
+    params.setdefault("format", IMAGE_FORMATS.get(os.path.splitext(path)[1][1:].lower()))
+    try:
+        image.save(temp_path, **params)
+        filename_counters.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        filename_counters.release(path)
+        raise
+
+class ImageWriter:
+
+    def __init__(self, workers, queue_size):
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.written = 0
+        self.errors = 0
+        self.waits = 0
+
+    def _start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                # Daemon threads so a stuck write cannot block exit, the atexit flush waits for the queue instead
+                thread = threading.Thread(target=self._run, name=f"cr_image_writer_{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    # Queue an image for writing, blocking while the queue is full
+    def submit(self, array, path, params):
+        self._start()
+        if self.queue.full():
+            with self.lock:
+                self.waits += 1
+            print(f"[Info] CR Image Output: Image writer queue is full, waiting for writes to finish")
+        self.queue.put((array, path, params))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, array, path, params):
+        try:
+            save_reserved_image(Image.fromarray(array), path, params)
+            with self.lock:
+                self.written += 1
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            print(f"[Warning] CR Image Output: Failed to write {path}: {e}")
+
+    # Wait until every queued image has been written
+    def flush(self):
+        if self.threads:
+            self.queue.join()
+
+    def shutdown(self):
+        self.flush()
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {"queued": self.queue.qsize(),
+                    "written": self.written,
+                    "errors": self.errors,
+                    "waits": self.waits,
+                   }
+
+image_writer = ImageWriter(IMAGE_WRITER_WORKERS, IMAGE_WRITER_QUEUE_SIZE)
+atexit.register(image_writer.shutdown)
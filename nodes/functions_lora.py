@@ -0,0 +1,348 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# LORA FUNCTIONS
+#---------------------------------------------------------------------------------------------------------------------#
+
+import os
+import threading
+import weakref
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import comfy.lora
+import comfy.sd
+import comfy.utils
+import folder_paths
+from safetensors import safe_open
+try:
+    import comfy.lora_convert as lora_convert
+except ImportError:
+    # ComfyUI versions before LoRA key conversion
+    lora_convert = None
+from .functions_cache import LRUCache, file_cache_key, object_nbytes
+from ..config import LORA_CACHE_BYTES, FUSED_LORA_STACK_CACHE_ITEMS, FUSED_LORA_STACK_CACHE_BYTES, LORA_PREFETCH_WORKERS, LORA_PREFETCH_MAX_BYTES, LORA_DELTA_CACHE_BYTES
+
+# LoRA state dicts shared by all LoRA nodes, keyed by resolved path and file mtime
+lora_cache = LRUCache("loras", LORA_CACHE_BYTES)
+
+# Memory-mapped LoRA files, sized by the tensor bytes in the file whether read or not
+lazy_lora_cache = LRUCache("lazy loras", LORA_CACHE_BYTES, sizeof=lambda lora: lora.file_bytes)
+
+# Bytes of the patch tensors held by a fused stack entry's patched model and clip
+def fused_lora_nbytes(entry):
+    nbytes = 0
+    for patcher in (entry[2], entry[3].patcher if entry[3] is not None else None):
+        if patcher is None:
+            continue
+        for key_patches in patcher.patches.values():
+            for p in key_patches:
+                # Newer ComfyUI wraps the tensors of a patch in a weight adapter
+                nbytes += object_nbytes(getattr(p[1], "weights", p[1]))
+    return nbytes
+
+# Patched model and clip for a LoRA stack on a base model, keyed by base model identity and stack signature.
+# Entries are (weak reference to the base model, to the base clip, patched model, patched clip) and are dropped
+# when the base model or clip is freed.
+fused_lora_cache = LRUCache("fused lora stacks", FUSED_LORA_STACK_CACHE_BYTES, max_items=FUSED_LORA_STACK_CACHE_ITEMS, sizeof=fused_lora_nbytes)
+
+# Dense LoRA deltas at strength 1, keyed by LoRA file and base model. Entries are (weak reference to the base
+# model, deltas) and are dropped when the base model is freed.
+lora_delta_cache = LRUCache("lora deltas", LORA_DELTA_CACHE_BYTES, sizeof=lambda entry: object_nbytes(entry[1]))
+
+# Text encoder keys in kohya and diffusers LoRA files
+CLIP_KEY_PREFIXES = ("lora_te", "text_encoder")
+
+SAFETENSORS_DTYPE_BYTES = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1,
+                           "F8_E4M3": 1, "F8_E5M2": 1}
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Lazy LoRA loading
+#---------------------------------------------------------------------------------------------------------------------#
+# comfy.lora.load_lora only looks up the keys that match the model, so a mapping that reads each tensor on first
+# access from a memory-mapped safetensors file never reads the unmatched keys.
+
+class LazyLoRA:
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = safe_open(path, framework="pt", device="cpu")
+        self.key_bytes = {}
+        for key in self.handle.keys():
+            tensor_slice = self.handle.get_slice(key)
+            numel = 1
+            for dim in tensor_slice.get_shape():
+                numel *= dim
+            self.key_bytes[key] = numel * SAFETENSORS_DTYPE_BYTES.get(tensor_slice.get_dtype(), 4)
+        self.file_bytes = sum(self.key_bytes.values())
+        self.tensors = {}
+        self.lock = threading.Lock()
+
+    def get_tensor(self, key):
+        with self.lock:
+            tensor = self.tensors.get(key)
+            if tensor is None:
+                tensor = self.handle.get_tensor(key)
+                self.tensors[key] = tensor
+            return tensor
+
+
+# Read-only state dict for one application of a LazyLoRA, optionally without the CLIP or UNet keys
+class LazyLoRAView(Mapping):
+
+    def __init__(self, lora, skip_clip=False, skip_model=False):
+        self.lora = lora
+        self.keys_set = set()
+        for key in lora.key_bytes:
+            is_clip = key.startswith(CLIP_KEY_PREFIXES)
+            if (is_clip and skip_clip) or (not is_clip and skip_model):
+                continue
+            self.keys_set.add(key)
+        self.accessed = set()
+
+    def __getitem__(self, key):
+        if key not in self.keys_set:
+            raise KeyError(key)
+        self.accessed.add(key)
+        return self.lora.get_tensor(key)
+
+    def __contains__(self, key):
+        return key in self.keys_set
+
+    def __iter__(self):
+        return iter(self.keys_set)
+
+    def __len__(self):
+        return len(self.keys_set)
+
+    # Bytes of the tensors this application used, and of the ones it never read
+    def bytes_used(self):
+        return sum(self.lora.key_bytes[k] for k in self.accessed)
+
+    def bytes_skipped(self):
+        return self.lora.file_bytes - self.bytes_used()
+
+# LoRA keys in the form comfy.lora.load_lora expects, as comfy.sd.load_lora_for_models converts them
+def convert_lora(lora):
+    if lora_convert is None:
+        return lora
+    if isinstance(lora, LazyLoRAView):
+        try:
+            return lora_convert.convert_lora(lora)
+        except AttributeError:
+            # Conversions that rename keys need a mutable dict, which reads every tensor of a lazy LoRA
+            return lora_convert.convert_lora(dict(lora))
+    # Conversions rename keys in place, so the cached state dict is left as loaded
+    return lora_convert.convert_lora(dict(lora))
+
+def load_lazy_lora(lora_path):
+    return lazy_lora_cache.get_or_load_file(lora_path, LazyLoRA)
+
+def _load_lora_file(path):
+    return comfy.utils.load_torch_file(path, safe_load=True)
+
+def load_lora(lora_name):
+    lora_path = folder_paths.get_full_path("loras", lora_name)
+
+    # Wait for a prefetch of this file rather than reading it a second time
+    with lora_prefetch_lock:
+        future = lora_prefetch_futures.get(os.path.realpath(lora_path))
+    if future is not None:
+        return future.result()
+
+    return lora_cache.get_or_load_file(lora_path, _load_lora_file)
+
+#---------------------------------------------------------------------------------------------------------------------#
+# LoRA prefetch
+#---------------------------------------------------------------------------------------------------------------------#
+# Reads every LoRA in a stack concurrently on an I/O thread pool as soon as the stack is known. Loads still
+# happen in stack order, each waiting for its own file. In-flight reads are bounded by LORA_PREFETCH_MAX_BYTES,
+# a file larger than the bound is read on its own.
+
+lora_prefetch_lock = threading.Lock()
+lora_prefetch_futures = {}
+lora_prefetch_executor = None
+lora_prefetch_budget = threading.Condition()
+lora_prefetch_inflight_bytes = 0
+
+def _prefetch_lora_file(path, nbytes):
+    global lora_prefetch_inflight_bytes
+    with lora_prefetch_budget:
+        while lora_prefetch_inflight_bytes > 0 and lora_prefetch_inflight_bytes + nbytes > LORA_PREFETCH_MAX_BYTES:
+            lora_prefetch_budget.wait()
+        lora_prefetch_inflight_bytes += nbytes
+    try:
+        return lora_cache.get_or_load_file(path, _load_lora_file)
+    finally:
+        with lora_prefetch_budget:
+            lora_prefetch_inflight_bytes -= nbytes
+            lora_prefetch_budget.notify_all()
+        with lora_prefetch_lock:
+            lora_prefetch_futures.pop(path, None)
+
+def prefetch_lora_stack(lora_stack):
+    global lora_prefetch_executor
+    if LORA_PREFETCH_WORKERS <= 0 or not lora_stack:
+        return
+
+    with lora_prefetch_lock:
+        if lora_prefetch_executor is None:
+            lora_prefetch_executor = ThreadPoolExecutor(max_workers=LORA_PREFETCH_WORKERS, thread_name_prefix="cr_lora_prefetch")
+
+        for lora in lora_stack:
+            lora_path = folder_paths.get_full_path("loras", lora[0])
+            if lora_path is None:
+                continue
+            key = file_cache_key(lora_path)
+            if key in lora_cache or key[0] in lora_prefetch_futures:
+                continue
+            lora_prefetch_futures[key[0]] = lora_prefetch_executor.submit(_prefetch_lora_file, key[0], os.path.getsize(key[0]))
+
+def apply_lora(model, clip, lora_name, strength_model, strength_clip, lazy=False):
+    lora_path = folder_paths.get_full_path("loras", lora_name)
+    if not lazy or not lora_path.endswith(".safetensors"):
+        lora = load_lora(lora_name)
+        return comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
+
+    # Keys for a part with zero strength are never read
+    skip_clip = clip is None or strength_clip == 0
+    skip_model = model is None or strength_model == 0
+    lora = LazyLoRAView(load_lazy_lora(lora_path), skip_clip, skip_model)
+
+    model_lora, clip_lora = comfy.sd.load_lora_for_models(None if skip_model else model, None if skip_clip else clip, lora, strength_model, strength_clip)
+    if skip_model:
+        model_lora = model
+    if skip_clip:
+        clip_lora = clip
+
+    print(f"[Info] CR LoRA: {lora_name} used {lora.bytes_used() / 1024 ** 2:.1f} MB, skipped {lora.bytes_skipped() / 1024 ** 2:.1f} MB of {lora.lora.file_bytes / 1024 ** 2:.1f} MB")
+    return model_lora, clip_lora
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Fused LoRA stacks
+#---------------------------------------------------------------------------------------------------------------------#
+# Applying a stack one LoRA at a time clones the model and clip patchers and rebuilds the key map for every entry.
+# The fused path builds the key map once, clones once and adds each LoRA's patches to the same clones.
+
+def lora_stack_signature(lora_stack):
+    signature = []
+    for lora_name, strength_model, strength_clip in lora_stack:
+        lora_path = folder_paths.get_full_path("loras", lora_name)
+        signature.append(file_cache_key(lora_path) + (strength_model, strength_clip))
+    return tuple(signature)
+
+def apply_lora_stack_fused(model, clip, lora_stack, lazy=False):
+    key = (id(model), id(clip), lora_stack_signature(lora_stack))
+
+    # The entry holds weak references to the base model and clip, so a reused id never matches a dead one
+    cached = fused_lora_cache.get(key)
+    if cached is not None and cached[0]() is model and (clip is None or cached[1]() is clip):
+        return cached[2], cached[3]
+
+    key_map = comfy.lora.model_lora_keys_unet(model.model, {})
+    if clip is not None:
+        key_map = comfy.lora.model_lora_keys_clip(clip.cond_stage_model, key_map)
+
+    model_lora = model.clone()
+    clip_lora = clip.clone() if clip is not None else None
+
+    for lora_name, strength_model, strength_clip in lora_stack:
+        lora_path = folder_paths.get_full_path("loras", lora_name)
+        if lazy and lora_path.endswith(".safetensors"):
+            lora = LazyLoRAView(load_lazy_lora(lora_path), clip is None or strength_clip == 0, strength_model == 0)
+        else:
+            lora = load_lora(lora_name)
+        loaded = comfy.lora.load_lora(convert_lora(lora), key_map)
+        if strength_model != 0:
+            model_lora.add_patches(loaded, strength_model)
+        if clip_lora is not None and strength_clip != 0:
+            clip_lora.add_patches(loaded, strength_clip)
+
+    fused_lora_cache.put(key, (weakref.ref(model), weakref.ref(clip) if clip is not None else None, model_lora, clip_lora))
+    weakref.finalize(model, fused_lora_cache.remove, key)
+    if clip is not None:
+        weakref.finalize(clip, fused_lora_cache.remove, key)
+    return model_lora, clip_lora
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Scaled LoRA deltas
+#---------------------------------------------------------------------------------------------------------------------#
+# LoRA, LoHa, LoKr and diff patches are linear in their strength, so the dense delta at strength 1 is computed once
+# per base model and added as a plain diff patch. A strength sweep then only rescales the cached delta at patch time,
+# instead of recomputing the low-rank product for every cell. DoRA and set patches are not linear in their strength,
+# so LoRAs with them use the normal patches.
+
+# LoRA file keys for patch types that cannot be scaled as a delta
+NON_ADDITIVE_LORA_SUFFIXES = (".dora_scale", ".set_weight")
+
+def _calculate_weight(patcher, patches, weight, key):
+    calculate_weight = getattr(comfy.lora, "calculate_weight", None)
+    if calculate_weight is not None:
+        return calculate_weight(patches, weight, key)
+    return patcher.calculate_weight(patches, weight, key)
+
+# Dense deltas for the loaded patches of a LoRA on a patcher's base model, or None if they do not fit the budget
+def lora_deltas(patcher, lora_path, loaded):
+    model = patcher.model
+    key = (file_cache_key(lora_path), id(model))
+
+    # The entry holds a weak reference to the base model, so a reused id never matches a dead model
+    cached = lora_delta_cache.get(key)
+    if cached is not None and cached[0]() is model:
+        return cached[1]
+
+    # Patches keyed by (weight key, offset) only cover part of a weight and stay normal patches
+    model_sd = patcher.model_state_dict()
+    keys = [k for k in loaded if isinstance(k, str) and k in model_sd]
+    nbytes = sum(object_nbytes(model_sd[k]) for k in keys)
+    if lora_delta_cache.max_bytes is not None and nbytes > lora_delta_cache.max_bytes:
+        print(f"[Warning] CR LoRA: Deltas for {os.path.basename(lora_path)} need {nbytes / 1024 ** 3:.2f} GB, over the "
+              f"{lora_delta_cache.max_bytes / 1024 ** 3:.2f} GB delta cache budget, using Patch mode")
+        return None
+
+    deltas = {}
+    for k in keys:
+        weight = model_sd[k]
+        base = weight.to(torch.float32)
+        # The (strength, patch, strength_model, offset, function) form ModelPatcher.add_patches stores
+        patched = _calculate_weight(patcher, [(1.0, loaded[k], 1.0, None, None)], base.clone(), k)
+        deltas[k] = ((patched - base).to(device=patcher.offload_device, dtype=weight.dtype),)
+
+    lora_delta_cache.put(key, (weakref.ref(model), deltas))
+    weakref.finalize(model, lora_delta_cache.remove, key)
+    return deltas
+
+# Deltas for a LoRA on a patcher's base model, or its normal patches when they cannot be scaled as a delta
+def _lora_patches(patcher, lora_path, lora, key_map, additive):
+    loaded = comfy.lora.load_lora(lora, key_map)
+    deltas = lora_deltas(patcher, lora_path, loaded) if additive else None
+    if deltas is None:
+        return loaded
+    patches = {k: v for k, v in loaded.items() if not isinstance(k, str)}
+    patches.update(deltas)
+    return patches
+
+def apply_lora_scaled(model, clip, lora_name, strength_model, strength_clip):
+    lora_path = folder_paths.get_full_path("loras", lora_name)
+    lora = convert_lora(load_lora(lora_name))
+
+    additive = not any(k.endswith(NON_ADDITIVE_LORA_SUFFIXES) for k in lora)
+    if not additive:
+        print(f"[Info] CR LoRA: {lora_name} has DoRA or set patches, using Patch mode")
+
+    model_lora = model
+    if strength_model != 0:
+        key_map = comfy.lora.model_lora_keys_unet(model.model, {})
+        model_lora = model.clone()
+        model_lora.add_patches(_lora_patches(model, lora_path, lora, key_map, additive), strength_model)
+
+    clip_lora = clip
+    if clip is not None and strength_clip != 0:
+        key_map = comfy.lora.model_lora_keys_clip(clip.cond_stage_model, {})
+        clip_lora = clip.clone()
+        clip_lora.add_patches(_lora_patches(clip.patcher, lora_path, lora, key_map, additive), strength_clip)
+
+    return model_lora, clip_lora
@@ -0,0 +1,248 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# MODEL MERGE FUNCTIONS
+#---------------------------------------------------------------------------------------------------------------------#
+
+import os
+import json
+import contextlib
+import hashlib
+import threading
+import torch
+import comfy.sd
+import folder_paths
+import safetensors.torch
+from safetensors import safe_open
+from .functions_cache import DiskCache, file_cache_key
+from .functions_checkpoint import UNET_PREFIX, CLIP_PREFIXES, VAE_PREFIXES, SAFETENSORS_DTYPES
+from ..config import MODEL_MERGE_CACHE_DIR, MODEL_MERGE_CACHE_BYTES
+
+# CLIP keys the patch merge never patches, so the base model's values are kept
+CLIP_SKIP_SUFFIXES = (".position_ids", ".logit_scale")
+
+# Per model (model_name, model_ratio, clip_ratio) after normalisation and the Weighted adjustment
+def merge_ratios(model_stack, merge_method, normalise_ratios, weight_factor):
+    sum_model_ratio = sum(model_tuple[1] for model_tuple in model_stack)
+    sum_clip_ratio = sum(model_tuple[2] for model_tuple in model_stack)
+
+    ratios = list()
+    for i, model_tuple in enumerate(model_stack):
+        model_name, model_ratio, clip_ratio = model_tuple
+
+        if sum_model_ratio != 1 and normalise_ratios == "Yes":
+            model_ratio = round(model_ratio / sum_model_ratio, 2)
+            if sum_clip_ratio != 0:
+                clip_ratio = round(clip_ratio / sum_clip_ratio, 2)
+
+        # Reassign extra weight to the second model
+        if merge_method == "Weighted" and i == 1:
+            model_ratio = 1 - weight_factor + (weight_factor * model_ratio)
+            clip_ratio = 1 - weight_factor + (weight_factor * clip_ratio)
+
+        ratios.append((model_name, model_ratio, clip_ratio))
+    return ratios
+
+# The recursive merge computes w = w * (1 - r_i) + w_i * r_i for each model after the first. Unrolled, every model
+# gets one coefficient: r_i times (1 - r_j) for each later model j, with r_0 = 1 for the base model.
+def fold_coefficients(ratios):
+    coefficients = [1.0]
+    for ratio in ratios[1:]:
+        coefficients = [c * (1.0 - ratio) for c in coefficients] + [ratio]
+    return coefficients
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Single pass merge
+#---------------------------------------------------------------------------------------------------------------------#
+# Instead of one add_patches call per model and key, which stacks N - 1 patches on every weight, the folded
+# coefficients give each key a single patch holding the merged weight.
+
+def single_pass_patches(patchers, ratios, filter_prefix=None, skip_suffixes=()):
+    state_dicts = [patcher.model_state_dict(filter_prefix) for patcher in patchers]
+    offload_device = patchers[0].offload_device
+
+    patches = {}
+    for key, base_tensor in state_dicts[0].items():
+        if skip_suffixes and key.endswith(skip_suffixes):
+            continue
+
+        # Models without this key, or with a different shape, are left out of the sum for it
+        tensors = []
+        key_ratios = [ratios[0]]
+        for state_dict, ratio in zip(state_dicts[1:], ratios[1:]):
+            tensor = state_dict.get(key)
+            if tensor is None or tensor.shape != base_tensor.shape:
+                continue
+            tensors.append(tensor)
+            key_ratios.append(ratio)
+
+        coefficients = fold_coefficients(key_ratios)
+        if all(c == 0 for c in coefficients[1:]):
+            continue
+        result = base_tensor.to(torch.float32) * coefficients[0]
+        for tensor, coefficient in zip(tensors, coefficients[1:]):
+            if coefficient != 0:
+                result.add_(tensor.to(device=result.device, dtype=torch.float32), alpha=coefficient)
+        patches[key] = (result.to(device=offload_device, dtype=base_tensor.dtype),)
+    return patches
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Streaming merge
+#---------------------------------------------------------------------------------------------------------------------#
+# Opens every checkpoint memory-mapped and merges one key at a time, so the source checkpoints are never held in
+# memory as a whole, only the tensors for the current key. The merged state dict is held in full, and building the
+# MODEL and CLIP from it copies the weights into the model, so peak memory is still about twice the size of the
+# merged UNet and CLIP. The VAE keys, and the keys of a model whose coefficient is 0, are never read.
+
+def merge_ratio_kind(key):
+    if key.startswith(UNET_PREFIX):
+        return "model"
+    if key.startswith(CLIP_PREFIXES) and not key.endswith(CLIP_SKIP_SUFFIXES):
+        return "clip"
+    return None
+
+def stream_merge(ckpt_paths, model_ratios, clip_ratios):
+    with contextlib.ExitStack() as stack:
+        handles = [stack.enter_context(safe_open(path, framework="pt", device="cpu")) for path in ckpt_paths]
+        return _stream_merge(handles, model_ratios, clip_ratios)
+
+def _stream_merge(handles, model_ratios, clip_ratios):
+    key_sets = [set(handle.keys()) for handle in handles]
+    base = handles[0]
+
+    # Tensor bytes in each file from the headers, to report what was skipped
+    file_bytes = []
+    for handle in handles:
+        nbytes = 0
+        for key in handle.keys():
+            tensor_slice = handle.get_slice(key)
+            meta = torch.empty(tensor_slice.get_shape(), dtype=SAFETENSORS_DTYPES.get(tensor_slice.get_dtype(), torch.float32), device="meta")
+            nbytes += meta.nelement() * meta.element_size()
+        file_bytes.append(nbytes)
+    bytes_read = [0] * len(handles)
+
+    merged = {}
+    stats = {"keys_merged": 0}
+    for key in key_sets[0]:
+        if key.startswith(VAE_PREFIXES):
+            continue
+        base_tensor = base.get_tensor(key)
+        bytes_read[0] += base_tensor.nelement() * base_tensor.element_size()
+
+        kind = merge_ratio_kind(key)
+        if kind is None:
+            merged[key] = base_tensor
+            continue
+        ratios = model_ratios if kind == "model" else clip_ratios
+
+        # Models without this key, or with a different shape, are left out of the sum for it
+        sources = []
+        key_ratios = [ratios[0]]
+        for i, (handle, key_set, ratio) in enumerate(zip(handles[1:], key_sets[1:], ratios[1:]), 1):
+            if key not in key_set:
+                continue
+            if tuple(handle.get_slice(key).get_shape()) != tuple(base_tensor.shape):
+                print(f"[Warning] Apply Model Merge: Shape mismatch for {key}, skipping")
+                continue
+            sources.append(i)
+            key_ratios.append(ratio)
+
+        coefficients = fold_coefficients(key_ratios)
+        result = base_tensor.to(torch.float32) * coefficients[0]
+        for i, coefficient in zip(sources, coefficients[1:]):
+            if coefficient == 0:
+                continue
+            tensor = handles[i].get_tensor(key)
+            bytes_read[i] += tensor.nelement() * tensor.element_size()
+            result.add_(tensor.to(torch.float32), alpha=coefficient)
+            del tensor
+        merged[key] = result.to(base_tensor.dtype)
+        stats["keys_merged"] += 1
+
+    stats["bytes_read"] = bytes_read
+    stats["bytes_skipped"] = [total - read for total, read in zip(file_bytes, bytes_read)]
+    return merged, stats
+
+# MODEL and CLIP from a merged checkpoint state dict
+def load_merged_state_dict(state_dict):
+    embedding_directory = folder_paths.get_folder_paths("embeddings")
+    load_state_dict = getattr(comfy.sd, "load_state_dict_guess_config", None)
+    if load_state_dict is not None:
+        out = load_state_dict(state_dict, output_vae=False, output_clip=True, embedding_directory=embedding_directory)
+        return out[0], out[1]
+
+    # Older ComfyUI versions can only load checkpoints from a file
+    temp_path = os.path.join(folder_paths.get_temp_directory(), f"cr_model_merge_{os.getpid()}.safetensors")
+    os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+    try:
+        safetensors.torch.save_file(state_dict, temp_path)
+        return load_merged_checkpoint(temp_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def load_merged_checkpoint(path):
+    out = comfy.sd.load_checkpoint_guess_config(path, output_vae=False, output_clip=True,
+                                                embedding_directory=folder_paths.get_folder_paths("embeddings"))
+    return out[0], out[1]
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Merge cache
+#---------------------------------------------------------------------------------------------------------------------#
+# Merged UNet and CLIP weights are saved as a checkpoint named by a hash of the recipe: the content hash of every
+# checkpoint in the stack plus the ratios and merge settings. Old merges are evicted when over the byte budget.
+
+merge_disk_cache = None
+checkpoint_hashes = {}
+checkpoint_hashes_lock = threading.Lock()
+
+def get_merge_disk_cache():
+    global merge_disk_cache
+    if merge_disk_cache is None:
+        directory = MODEL_MERGE_CACHE_DIR or os.path.join(folder_paths.models_dir, "cr_merge_cache")
+        merge_disk_cache = DiskCache("merged models", directory, MODEL_MERGE_CACHE_BYTES)
+    return merge_disk_cache
+
+# Content hash of a checkpoint file. Hashes are kept in an index in the cache directory keyed by path, size and
+# mtime, so each version of a file is only read for hashing once.
+def checkpoint_hash(ckpt_path):
+    real_path, mtime = file_cache_key(ckpt_path)
+    index_key = f"{real_path}|{os.path.getsize(real_path)}|{mtime}"
+    index_path = os.path.join(get_merge_disk_cache().directory, "checkpoint_hashes.json")
+
+    with checkpoint_hashes_lock:
+        if not checkpoint_hashes and os.path.isfile(index_path):
+            try:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    checkpoint_hashes.update(json.load(f))
+            except (OSError, ValueError):
+                print(f"[Warning] Apply Model Merge: Could not read {index_path}, checkpoints will be hashed again")
+
+        digest = checkpoint_hashes.get(index_key)
+        if digest is None:
+            h = hashlib.blake2b(digest_size=20)
+            with open(real_path, "rb") as f:
+                for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            checkpoint_hashes[index_key] = digest
+
+            temp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(checkpoint_hashes, f)
+            os.replace(temp_path, index_path)
+    return digest
+
+def merge_recipe_key(model_stack, merge_method, normalise_ratios, weight_factor):
+    h = hashlib.blake2b(digest_size=20)
+    for model_name, model_ratio, clip_ratio in model_stack:
+        ckpt_path = folder_paths.get_full_path("checkpoints", model_name)
+        h.update(repr((checkpoint_hash(ckpt_path), model_ratio, clip_ratio)).encode('utf-8'))
+    h.update(repr((merge_method, normalise_ratios, weight_factor)).encode('utf-8'))
+    return h.hexdigest()
+
+def save_merged_checkpoint(path, model, clip):
+    comfy.sd.save_checkpoint(path, model, clip=clip)
@@ -9,13 +9,30 @@
 # These functions are based on WAS nodes Image Resize and the Comfy Extras upscale with model nodes
 
 import torch
-#import os
+import math
+import time
+import os
+import hashlib
+import threading
 from comfy_extras.chainner_models import model_loading
 from comfy import model_management
 import numpy as np
 import comfy.utils
 import folder_paths
 from PIL import Image
+import safetensors.torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from safetensors import safe_open
+from .functions_cache import LRUCache, DiskCache, object_nbytes, file_cache_key, tensor_hash
+from ..config import UPSCALE_MODEL_CACHE_BYTES, UPSCALE_RESULT_CACHE_BYTES, UPSCALE_RESULT_DISK_CACHE_BYTES, UPSCALE_RESULT_CACHE_DIR
+
+# Upscale models shared by all upscale nodes, keyed by resolved path and file mtime
+upscale_model_cache = LRUCache("upscale models", UPSCALE_MODEL_CACHE_BYTES)
+
+# Upscaled images keyed by input content hash, model chain and resize parameters
+upscale_result_cache = LRUCache("upscale results", UPSCALE_RESULT_CACHE_BYTES)
+upscale_result_disk_cache = None
 
 # PIL to Tensor
 def pil2tensor(image):
@@ -25,40 +42,217 @@ def pil2tensor(image):
 def tensor2pil(image):
     return Image.fromarray(np.clip(255. * image.cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
 
-def load_model(model_name):
-    model_path = folder_paths.get_full_path("upscale_models", model_name)
+def load_model_from_path(model_path):
     sd = comfy.utils.load_torch_file(model_path, safe_load=True)
     if "module.layers.0.residual_group.blocks.0.norm1.weight" in sd:
         sd = comfy.utils.state_dict_prefix_replace(sd, {"module.":""})
     out = model_loading.load_state_dict(sd).eval()
     return out
+
+def load_model(model_name):
+    model_path = folder_paths.get_full_path("upscale_models", model_name)
+    return upscale_model_cache.get_or_load_file(model_path, load_model_from_path)
+
+# Model scales by resolved path and file mtime, read without loading the weights where possible
+upscale_model_scales = {}
+
+# Build the model from the tensor shapes in a safetensors header on the meta device, which reads no weights
+def read_model_scale(model_path):
+    sd = {}
+    with safe_open(model_path, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            # Only the shapes decide the architecture and scale
+            sd[key] = torch.empty(f.get_slice(key).get_shape(), device="meta")
+    if "module.layers.0.residual_group.blocks.0.norm1.weight" in sd:
+        sd = comfy.utils.state_dict_prefix_replace(sd, {"module.":""})
+    with torch.device("meta"):
+        return model_loading.load_state_dict(sd).scale
+
+def upscale_model_scale(model_name):
+    model_path = folder_paths.get_full_path("upscale_models", model_name)
+    key = file_cache_key(model_path)
+    if key in upscale_model_scales:
+        return upscale_model_scales[key]
+
+    model = upscale_model_cache.get(key)
+    scale = model.scale if model is not None else None
+    if scale is None and model_path.endswith(".safetensors"):
+        try:
+            scale = read_model_scale(key[0])
+        except Exception as e:
+            # Architectures that cannot be built on the meta device are loaded in full below
+            print(f"[Info] Upscale: Could not read the scale of {model_name} from its header, loading it ({e})")
+    if scale is None:
+        scale = load_model(model_name).scale
+    upscale_model_scales[key] = scale
+    return scale
     
-def upscale_with_model(upscale_model, image):
+# Tile sizes tried by the planner, largest first
+TILE_SIZES = [512, 384, 256, 192, 128, 96, 64]
+PROFILE_TILE = 32
+
+# Measure activation memory per input pixel once per model, using a small probe tile
+def profile_model_memory(upscale_model, channels, device, dtype):
+    profile = getattr(upscale_model, "cr_memory_profile", None)
+    if profile is not None:
+        return profile
+
+    output_sizes = []
+    def record_output(module, inputs, output):
+        if isinstance(output, torch.Tensor):
+            output_sizes.append(output.nelement() * output.element_size())
+
+    probe = torch.zeros((1, channels, PROFILE_TILE, PROFILE_TILE), device=device, dtype=dtype)
+    handles = [m.register_forward_hook(record_output) for m in upscale_model.modules()]
+    peak = 0
+    try:
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device)
+        with torch.no_grad():
+            upscale_model(probe)
+        if device.type == "cuda":
+            peak = torch.cuda.max_memory_allocated(device) - baseline
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    # The largest few activations are alive at the same time in residual blocks
+    live = sum(sorted(output_sizes, reverse=True)[:3])
+    profile = max(peak, live) / (PROFILE_TILE * PROFILE_TILE)
+    upscale_model.cr_memory_profile = profile
+    return profile
+
+# Pick tile size and overlap that fit the free memory, or max_tile_memory_mb if set
+def plan_tiles(upscale_model, in_img, device, max_tile_memory_mb=0, concurrent_tiles=1):
+    batch, channels, height, width = in_img.shape
+    scale = upscale_model.scale
+    element_size = in_img.element_size()
+    per_pixel = profile_model_memory(upscale_model, channels, device, in_img.dtype)
+
+    # tiled_scale keeps an output and a divisor buffer for the whole batch on the CPU, so they only take from
+    # the tile budget when the tiles run on the CPU too
+    output_bytes = 2 * batch * channels * round(height * scale) * round(width * scale) * element_size
+    budget = model_management.get_free_memory(device)
+    if device.type == "cpu":
+        budget -= output_bytes
+    elif output_bytes > model_management.get_free_memory(torch.device("cpu")):
+        print(f"[Warning] Upscale: The upscaled batch needs {output_bytes / 1024 ** 2:.0f} MB of RAM, more than is free")
+    if max_tile_memory_mb > 0:
+        budget = min(budget, max_tile_memory_mb * 1024 * 1024)
+    budget *= 0.8 / max(concurrent_tiles, 1)
+
+    for tile in TILE_SIZES:
+        tile_out = round(tile * scale)
+        tile_bytes = per_pixel * tile * tile + 3 * channels * tile_out * tile_out * element_size
+        if tile_bytes <= budget:
+            return tile, min(32, tile // 4)
+
+    print(f"[Warning] Upscale: Not enough memory for the smallest tile size, using {TILE_SIZES[-1]}")
+    return TILE_SIZES[-1], TILE_SIZES[-1] // 4
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Threaded CPU tiling
+#---------------------------------------------------------------------------------------------------------------------#
+# Same tiling and feathered blending as the original single loop comfy.utils.tiled_scale, but the model runs on
+# several tiles at once. Tiles are blended into the output in the serial order, so the result is identical to that
+# loop. Newer ComfyUI versions route tiled_scale through tiled_scale_multidim, which places the last tile of each row
+# and column inside the image, so there the results match except for the blending near the right and bottom edges.
+#
+# torch.set_num_threads is per thread with OpenMP but process-wide with the native thread pool, so each worker sets
+# its count and the caller's count is saved before the run and restored after it, even on error. The count is only
+# changed while the run lasts, and a lock keeps two threaded runs from restoring each other's setting.
+
+tiled_scale_threads_lock = threading.Lock()
+
+def _feather_mask(ps, overlap, upscale_amount):
+    mask = torch.ones_like(ps)
+    feather = round(overlap * upscale_amount)
+    for t in range(feather):
+        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
+        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
+        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
+        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
+    return mask
+
+@torch.inference_mode()
+def tiled_scale_threaded(samples, function, tile_x=64, tile_y=64, overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", pbar=None, workers=4, threads_per_worker=1):
+
+    # Run the model under inference mode in each worker, which is thread local
+    def run_tile(s_in):
+        with torch.inference_mode():
+            return function(s_in).to(output_device)
+
+    def init_worker():
+        torch.set_num_threads(threads_per_worker)
+
+    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
+    with tiled_scale_threads_lock:
+        main_threads = torch.get_num_threads()
+        try:
+            with ThreadPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+                for b in range(samples.shape[0]):
+                    s = samples[b:b+1]
+                    out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
+                    out_div = torch.zeros_like(out)
+                    positions = [(y, x) for y in range(0, s.shape[2], tile_y - overlap) for x in range(0, s.shape[3], tile_x - overlap)]
+
+                    # Keep a bounded number of tiles in flight and blend them in submission order
+                    pending = deque()
+                    next_tile = 0
+                    while next_tile < len(positions) or pending:
+                        while next_tile < len(positions) and len(pending) < workers * 2:
+                            y, x = positions[next_tile]
+                            pending.append((y, x, executor.submit(run_tile, s[:,:,y:y+tile_y,x:x+tile_x])))
+                            next_tile += 1
+                        y, x, future = pending.popleft()
+                        ps = future.result()
+                        mask = _feather_mask(ps, overlap, upscale_amount)
+                        out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
+                        out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
+                        if pbar is not None:
+                            pbar.update(1)
+
+                    output[b:b+1] = out/out_div
+        finally:
+            # The workers have exited, so the count set by them with the native thread pool is put back
+            torch.set_num_threads(main_threads)
+    return output
+
+def upscale_with_model(upscale_model, image, max_tile_memory_mb=0, cpu_workers=0, cpu_threads_per_worker=1):
     device = model_management.get_torch_device()
     upscale_model.to(device)
     in_img = image.movedim(-1,-3).to(device)
-    free_memory = model_management.get_free_memory(device)
 
-    tile = 512
-    overlap = 32
+    # Threaded tiles are only used on CPU, GPU kernels already fill the device
+    threaded = device.type == "cpu" and cpu_workers > 1
+
+    tile, overlap = plan_tiles(upscale_model, in_img, device, max_tile_memory_mb, cpu_workers if threaded else 1)
 
+    # The planner should avoid OOM, halving the tile is only a safety net
     oom = True
     while oom:
         try:
             steps = in_img.shape[0] * comfy.utils.get_tiled_scale_steps(in_img.shape[3], in_img.shape[2], tile_x=tile, tile_y=tile, overlap=overlap)
             pbar = comfy.utils.ProgressBar(steps)
-            s = comfy.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar)
+            if threaded:
+                s = tiled_scale_threaded(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar,
+                                         workers=cpu_workers, threads_per_worker=cpu_threads_per_worker)
+            else:
+                s = comfy.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar)
             oom = False
         except model_management.OOM_EXCEPTION as e:
+            print(f"[Warning] Upscale: Out of memory with planned tile size {tile}, retrying with {tile // 2}")
             tile //= 2
-            if tile < 128:
+            overlap = min(overlap, tile // 4)
+            if tile < TILE_SIZES[-1]:
                 raise e
 
     upscale_model.cpu()
     s = torch.clamp(s.movedim(-3,-1), min=0, max=1.0)
     return s        
 
-def apply_resize_image(image: Image.Image, original_width, original_height, rounding_modulus, mode='scale', supersample='true', factor: int = 2, width: int = 1024, height: int = 1024, resample='bicubic'): 
+def get_resize_dims(original_width, original_height, rounding_modulus, mode='scale', factor: int = 2, width: int = 1024):
 
     # Calculate the new width and height based on the given mode and parameters
     if mode == 'rescale':
@@ -71,16 +265,361 @@ def apply_resize_image(image: Image.Image, original_width, original_height, roun
         new_width = width if width % m == 0 else width + (m - width % m)
         new_height = height if height % m == 0 else height + (m - height % m)
 
+    return new_width, new_height
+
+def apply_resize_image(image: Image.Image, original_width, original_height, rounding_modulus, mode='scale', supersample='true', factor: int = 2, width: int = 1024, height: int = 1024, resample='bicubic'): 
+
+    new_width, new_height = get_resize_dims(original_width, original_height, rounding_modulus, mode, factor, width)
+
     # Define a dictionary of resampling filters
     resample_filters = {'nearest': 0, 'bilinear': 2, 'bicubic': 3, 'lanczos': 1}
     
-    # Apply supersample
+    # Apply supersample without building the whole 8x intermediate image
     if supersample == 'true':
-        image = image.resize((new_width * 8, new_height * 8), resample=Image.Resampling(resample_filters[resample]))
+        return tensor2pil(quantize_(supersample_tensor(pil2tensor(image), new_width, new_height, resample)))
+
+    # Legacy supersample, resizes to 8x the target size first
+    if supersample == 'legacy':
+        image = image.resize((new_width * SUPERSAMPLE_FACTOR, new_height * SUPERSAMPLE_FACTOR), resample=Image.Resampling(resample_filters[resample]))
 
     # Resize the image using the given resampling filter
     resized_image = image.resize((new_width, new_height), resample=Image.Resampling(resample_filters[resample]))
     
     return resized_image  
 
+#---------------------------------------------------------------------------------------------------------------------#
+# Torch resize engine
+#---------------------------------------------------------------------------------------------------------------------#
+# Resizes a whole NHWC batch in torch using the same separable, antialiased convolution as PIL's Image.resize.
+# Weights are computed in float64 and each pass is applied as a banded matrix multiply. The horizontal pass is
+# rounded to 8 bits before the vertical pass as PIL does, so results match PIL to within 2/255 per channel.
+# Nearest picks the same pixels as PIL.
+
+# supersample='true' streams the 8x intermediate in blocks of output rows, 'legacy' builds all of it
+SUPERSAMPLE_FACTOR = 8
+SUPERSAMPLE_BLOCK_BYTES = 128 * 1024 ** 2
+
+def _sinc(x):
+    return torch.where(x == 0, torch.ones_like(x), torch.sin(math.pi * x) / (math.pi * x))
+
+def _bilinear_filter(x):
+    x = x.abs()
+    return torch.clamp(1.0 - x, min=0.0)
+
+def _bicubic_filter(x):
+    a = -0.5
+    x = x.abs()
+    near = ((a + 2.0) * x - (a + 3.0)) * x * x + 1.0
+    far = (((x - 5.0) * x + 8.0) * x - 4.0) * a
+    return torch.where(x < 1.0, near, torch.where(x < 2.0, far, torch.zeros_like(x)))
+
+def _lanczos_filter(x):
+    return torch.where(x.abs() < 3.0, _sinc(x) * _sinc(x / 3.0), torch.zeros_like(x))
+
+# Filter function and support, matching PIL
+RESAMPLE_KERNELS = {
+    'bilinear': (_bilinear_filter, 1.0),
+    'bicubic': (_bicubic_filter, 2.0),
+    'lanczos': (_lanczos_filter, 3.0),
+}
+
+# Taps and weights for resizing one axis, as (out_size, taps) index and weight tensors
+def resample_weights(in_size, out_size, resample):
+    scale = in_size / out_size
+    centers = (torch.arange(out_size, dtype=torch.float64) + 0.5) * scale
+
+    # PIL steps the source coordinate by adding the scale, which can land on a different pixel than multiplying
+    if resample == 'nearest':
+        steps = torch.full((out_size,), scale, dtype=torch.float64)
+        steps[0] = scale * 0.5
+        indices = torch.clamp(steps.cumsum(0).long(), max=in_size - 1).unsqueeze(1)
+        return indices, torch.ones((out_size, 1), dtype=torch.float64)
+
+    kernel, kernel_support = RESAMPLE_KERNELS[resample]
+    filter_scale = max(scale, 1.0)
+    support = kernel_support * filter_scale
+    taps = int(math.ceil(support)) * 2 + 1
+
+    x_min = torch.clamp((centers - support + 0.5).floor(), min=0)
+    x_max = torch.clamp((centers + support + 0.5).floor(), max=in_size)
+    positions = x_min.unsqueeze(1) + torch.arange(taps, dtype=torch.float64).unsqueeze(0)
+
+    weights = kernel((positions - centers.unsqueeze(1) + 0.5) / filter_scale)
+    weights = torch.where(positions < x_max.unsqueeze(1), weights, torch.zeros_like(weights))
+    weights = weights / weights.sum(dim=1, keepdim=True)
+    indices = torch.clamp(positions.long(), max=in_size - 1)
+    return indices, weights
+
+# Resize a tensor along one dimension with precomputed taps. Output rows are done in blocks, each as one matrix
+# multiply with the taps scattered into the band of inputs the block reads.
+RESAMPLE_BLOCK = 16
+
+def resample_axis(images, dim, indices, weights):
+    indices = indices.to(images.device)
+
+    # Nearest has a single tap of weight 1
+    if indices.shape[1] == 1:
+        return images.index_select(dim, indices[:, 0])
+
+    in_size, out_size = images.shape[dim], indices.shape[0]
+    weights = weights.to(device=images.device, dtype=images.dtype)
+
+    # View as (outer, in_size, inner). A few interleaved channels are kept in place by expanding each weight
+    # to a diagonal block, which is cheaper than transposing the image for a wider matmul.
+    outer = math.prod(images.shape[:dim])
+    inner = math.prod(images.shape[dim + 1:])
+    interleaved = inner <= 4
+    if interleaved:
+        x = images.reshape(outer, in_size * inner)
+        out = x.new_empty((outer, out_size * inner))
+        eye = torch.eye(inner, device=images.device, dtype=images.dtype)
+    else:
+        x = images.reshape(outer, in_size, inner)
+        out = x.new_empty((outer, out_size, inner))
+
+    first, last = indices.min(dim=1).values.tolist(), indices.max(dim=1).values.tolist()
+    for start in range(0, out_size, RESAMPLE_BLOCK):
+        end = min(start + RESAMPLE_BLOCK, out_size)
+        lo, hi = min(first[start:end]), max(last[start:end]) + 1
+        band = weights.new_zeros((hi - lo, end - start)).scatter_add_(0, (indices[start:end] - lo).t(), weights[start:end].t())
+        if interleaved:
+            torch.matmul(x[:, lo * inner:hi * inner], torch.kron(band, eye), out=out[:, start * inner:end * inner])
+        else:
+            torch.matmul(band.t(), x[:, lo:hi], out=out[:, start:end])
+
+    return out.reshape(images.shape[:dim] + (out_size,) + images.shape[dim + 1:])
+
+# Round to 8 bits in place, as PIL does between passes
+def quantize_(images):
+    return images.clamp_(min=0, max=1.0).mul_(255).round_().div_(255)
+
+# Resize an NHWC batch to new_width x new_height, horizontal pass first as in PIL. Always returns a new tensor.
+def resize_tensor(images, new_width, new_height, resample='bicubic'):
+    height, width = images.shape[1], images.shape[2]
+
+    # Nearest only picks pixels, so both axes are gathered in one step
+    if resample == 'nearest':
+        rows = resample_weights(height, new_height, resample)[0].to(images.device)
+        cols = resample_weights(width, new_width, resample)[0].to(images.device)
+        return images[:, rows, cols.t()]
+
+    if width == new_width and height == new_height:
+        return images.clone()
+    if width != new_width:
+        images = resample_axis(images, 2, *resample_weights(width, new_width, resample))
+        if height != new_height:
+            images = quantize_(images)
+    if height != new_height:
+        images = resample_axis(images, 1, *resample_weights(height, new_height, resample))
+    return images
+
+# Same result as resizing to supersample x the new size, rounding, and resizing down, but only the rows of the
+# large image needed for one block of output rows are held at a time
+def supersample_tensor(images, new_width, new_height, resample='bicubic', supersample=SUPERSAMPLE_FACTOR):
+    batch_size, height, width, channels = images.shape
+    large_width, large_height = new_width * supersample, new_height * supersample
+
+    # Nearest picks a pixel of the large image, which is itself a pixel of the input
+    if resample == 'nearest':
+        rows = resample_weights(height, large_height, resample)[0][resample_weights(large_height, new_height, resample)[0][:, 0]]
+        cols = resample_weights(width, large_width, resample)[0][resample_weights(large_width, new_width, resample)[0][:, 0]]
+        return images[:, rows.to(images.device), cols.t().to(images.device)]
+
+    up_width = resample_weights(width, large_width, resample)
+    up_indices, up_weights = resample_weights(height, large_height, resample)
+    down_width = resample_weights(large_width, new_width, resample)
+    down_indices, down_weights = resample_weights(large_height, new_height, resample)
+
+    row_bytes = batch_size * large_width * channels * images.element_size() * supersample
+    block = max(1, SUPERSAMPLE_BLOCK_BYTES // row_bytes)
+    out = images.new_empty((batch_size, new_height, new_width, channels))
+    for start in range(0, new_height, block):
+        end = min(start + block, new_height)
+
+        # Rows of the large image read by this block, and the input rows they are made from
+        large_lo, large_hi = int(down_indices[start:end].min()), int(down_indices[start:end].max()) + 1
+        rows_indices, rows_weights = up_indices[large_lo:large_hi], up_weights[large_lo:large_hi]
+        in_lo, in_hi = int(rows_indices.min()), int(rows_indices.max()) + 1
+
+        # Up to the large size and back down, rounding after every pass as resizing twice with PIL does
+        large = quantize_(resample_axis(images[:, in_lo:in_hi], 2, *up_width))
+        large = quantize_(resample_axis(large, 1, rows_indices - in_lo, rows_weights))
+        large = quantize_(resample_axis(large, 2, *down_width))
+        out[:, start:end] = resample_axis(large, 1, down_indices[start:end] - large_lo, down_weights[start:end])
+    return out
+
+def resize_image_batch(images, original_width, original_height, rounding_modulus, mode='scale', supersample='true', factor: int = 2, width: int = 1024, resample='bicubic'):
+
+    new_width, new_height = get_resize_dims(original_width, original_height, rounding_modulus, mode, factor, width)
+
+    # Supersample without building the whole 8x intermediate image
+    if supersample == 'true':
+        images = supersample_tensor(images, new_width, new_height, resample)
+    else:
+        if supersample == 'legacy':
+            images = quantize_(resize_tensor(images, new_width * SUPERSAMPLE_FACTOR, new_height * SUPERSAMPLE_FACTOR, resample))
+        images = resize_tensor(images, new_width, new_height, resample)
+    return images.clamp_(min=0, max=1.0)
+
+# Resize an upscaled NHWC batch with the selected engine
+def apply_resize_batch(images, original_width, original_height, rounding_modulus, mode='scale', supersample='true', factor: int = 2, width: int = 1024, resample='bicubic', resize_engine='pil'):
+
+    if resize_engine == 'torch':
+        return resize_image_batch(images, original_width, original_height, rounding_modulus, mode, supersample, factor, width, resample)
+
+    scaled_images = []
+    for img in images:
+        scaled_images.append(pil2tensor(apply_resize_image(tensor2pil(img), original_width, original_height, rounding_modulus, mode, supersample, factor, width, resample=resample)))
+    return torch.cat(scaled_images, dim=0)
+
+# Run a batch through every stage of an upscale stack, returning the result and the peak bytes held by a stage.
+# A stage with model "None" only resizes. Per stage model output megapixels and seconds are added to stage_stats.
+def apply_upscale_stack(image, upscale_stack, original_width, original_height, resampling_method, supersample, rounding_modulus, max_tile_memory_mb=0, resize_engine='pil', cpu_workers=0, cpu_threads_per_worker=1, stage_stats=None):
+
+    peak_bytes = 0
+    for i, (upscale_model, rescale_factor) in enumerate(upscale_stack):
+        start_time = time.perf_counter()
+
+        if upscale_model == "None":
+            up_image = image
+        else:
+            # Load upscale model 
+            up_model = load_model(upscale_model)
+
+            # Upscale with model
+            up_image = upscale_with_model(up_model, image, max_tile_memory_mb, cpu_workers, cpu_threads_per_worker)
+        upscaled_width = up_image.shape[2]
+
+        # Skip the resize if no rescale needed
+        if upscaled_width == original_width and rescale_factor == 1:
+            scaled_image = up_image
+        else:
+            scaled_image = apply_resize_batch(up_image, original_width, original_height, rounding_modulus, "rescale", supersample, rescale_factor, 1024, resampling_method, resize_engine)
+
+        stage_bytes = object_nbytes(image) + object_nbytes(up_image)
+        if scaled_image is not up_image:
+            stage_bytes += object_nbytes(scaled_image)
+        peak_bytes = max(peak_bytes, stage_bytes)
+
+        if stage_stats is not None:
+            if len(stage_stats) <= i:
+                stage_stats.append({"megapixels": 0.0, "seconds": 0.0})
+            if upscale_model != "None":
+                stage_stats[i]["megapixels"] += up_image.shape[0] * up_image.shape[1] * up_image.shape[2] / 1e6
+            stage_stats[i]["seconds"] += time.perf_counter() - start_time
+
+        image = scaled_image
+        del up_image
+
+    return image, peak_bytes
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Upscale stack planner
+#---------------------------------------------------------------------------------------------------------------------#
+# Each stage resizes to original size x rescale_factor after its model, so a model whose output is then shrunk
+# spent time on pixels that are thrown away. The planner lowers the size fed to each model to the smallest
+# that still reaches the next stage's size without resizing up, working back from the target.
+# Models are never reordered or dropped, as that would change the image content.
+
+# Smallest factor whose size, after a model of this scale, is at least out_factor on both axes
+def _min_input_factor(out_factor, scale, original_width, original_height):
+    min_width = math.ceil(int(original_width * out_factor) / scale)
+    min_height = math.ceil(int(original_height * out_factor) / scale)
+    return max(min_width / original_width, min_height / original_height)
+
+# Estimated model output megapixels per stage, the cost of a stage is dominated by the model
+def estimate_stack_cost(upscale_stack, model_scales, original_width, original_height, batch_size=1):
+    costs = []
+    in_factor = 1.0
+    for upscale_model, rescale_factor in upscale_stack:
+        if upscale_model == "None":
+            costs.append(0.0)
+        else:
+            scale = model_scales[upscale_model]
+            in_width, in_height = int(original_width * in_factor), int(original_height * in_factor)
+            costs.append(batch_size * in_width * scale * in_height * scale / 1e6)
+        in_factor = rescale_factor
+    return costs
+
+def plan_upscale_stack(upscale_stack, model_scales, original_width, original_height, target_factor):
+    stages = [[upscale_model, rescale_factor] for upscale_model, rescale_factor in upscale_stack]
+    if not stages:
+        return []
+
+    # The last stage resizes to the target
+    stages[-1][1] = target_factor
+
+    # Walk back from the target, lowering the input size of each model stage
+    pre_factor = None
+    for i in range(len(stages) - 1, -1, -1):
+        upscale_model, out_factor = stages[i]
+        if upscale_model == "None":
+            min_factor = out_factor
+        else:
+            min_factor = _min_input_factor(out_factor, model_scales[upscale_model], original_width, original_height)
+        in_factor = stages[i - 1][1] if i > 0 else 1.0
+        if min_factor < in_factor:
+            if i > 0:
+                stages[i - 1][1] = min_factor
+            elif upscale_model != "None":
+                pre_factor = min_factor
+    if pre_factor is not None:
+        stages.insert(0, ["None", pre_factor])
+
+    # Fuse resize-only stages into the stage after them and drop ones that do not change the size
+    planned = []
+    in_factor = 1.0
+    for i, (upscale_model, out_factor) in enumerate(stages):
+        is_last = i == len(stages) - 1
+        if upscale_model == "None":
+            if not is_last and stages[i + 1][0] == "None":
+                continue
+            # Keep a lone stage so the plan is never empty
+            if out_factor == in_factor and (planned or not is_last):
+                continue
+        planned.append((upscale_model, out_factor))
+        in_factor = out_factor
+    return planned
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Upscale result cache
+#---------------------------------------------------------------------------------------------------------------------#
+# Tile size is left out of the key, it only changes the overlap blending and depends on free memory at run time
+
+def get_upscale_result_disk_cache():
+    global upscale_result_disk_cache
+    if upscale_result_disk_cache is None:
+        directory = UPSCALE_RESULT_CACHE_DIR or os.path.join(folder_paths.models_dir, "cr_upscale_cache")
+        upscale_result_disk_cache = DiskCache("upscale results", directory, UPSCALE_RESULT_DISK_CACHE_BYTES)
+    return upscale_result_disk_cache
+
+def upscale_result_key(image, upscale_models, *params):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(tensor_hash(image).encode('utf-8'))
+    for model_name in upscale_models:
+        model_path = folder_paths.get_full_path("upscale_models", model_name)
+        h.update(repr((model_name,) + file_cache_key(model_path)).encode('utf-8'))
+    h.update(repr(params).encode('utf-8'))
+    return h.hexdigest()
+
+# Return the cached result for key, or compute and cache it. result_cache is "Off", "Memory" or "Memory + Disk"
+def cached_upscale_result(result_cache, key, compute):
+    if result_cache == "Off":
+        return compute()
+
+    image = upscale_result_cache.get(key)
+    if image is not None:
+        return image
+
+    disk_cache = get_upscale_result_disk_cache() if result_cache == "Memory + Disk" else None
+    if disk_cache is not None:
+        path = disk_cache.get_path(key)
+        if path is not None:
+            image = safetensors.torch.load_file(path)["image"]
+            return upscale_result_cache.put(key, image)
 
+    image = compute()
+    upscale_result_cache.put(key, image)
+    if disk_cache is not None:
+        disk_cache.put_file(key, lambda path: safetensors.torch.save_file({"image": image.contiguous()}, path))
+    return image
@@ -13,6 +13,8 @@ from PIL import Image, ImageEnhance
 import numpy as np
 import io
 from ..categories import icons
+from .functions_lora import apply_lora
+from .functions_checkpoint import load_checkpoint, preload_checkpoint
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "comfy"))
 #---------------------------------------------------------------------------------------------------------------------# 
@@ -38,6 +40,8 @@ class CR_CycleModels:
                              "loops": ("INT", {"default": 1, "min": 1, "max": 1000}),
                              "current_frame": ("INT", {"default": 0.0, "min": 0.0, "max": 9999.0, "step": 1.0,}),
                 },
+                "optional": {"preload_frames": ("INT", {"default": 0, "min": 0, "max": 9999}),
+                },
         }
     
     RETURN_TYPES = ("MODEL", "CLIP", "VAE", "STRING", )
@@ -45,7 +49,7 @@ class CR_CycleModels:
     FUNCTION = "cycle_models"
     CATEGORY = icons.get("Comfyroll/Animation/Legacy")
 
-    def cycle_models(self, mode, model, clip, model_list, frame_interval, loops, current_frame,):
+    def cycle_models(self, mode, model, clip, model_list, frame_interval, loops, current_frame, preload_frames=0):
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Cycler-Nodes#cr-cycle-models"
 
         # Initialize the list
@@ -74,10 +78,15 @@ class CR_CycleModels:
                 print(f"[Info] CR Cycle Models: Current model is {ckpt_name}")
                 
                 # Load the current model
-                ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-                out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, 
-                embedding_directory=folder_paths.get_folder_paths("embeddings"))
-                return (out, show_help, )
+                out = load_checkpoint(ckpt_name, owner=self)
+
+                # Start loading the next model in the cycle if it is due within preload_frames frames
+                if preload_frames > 0:
+                    next_model_index = ((current_frame + preload_frames) // frame_interval) % len(model_params)
+                    if next_model_index != current_model_index:
+                        next_model_index = (current_model_index + 1) % len(model_params)
+                        preload_checkpoint(model_params[next_model_index][1])
+                return (*out, show_help, )
         #else:
         #    return (model, clip) 
  
@@ -127,14 +136,10 @@ class CR_CycleLoRAs:
             current_lora_params = lora_params[current_lora_index]
             lora_alias, lora_name, model_strength, clip_strength = current_lora_params
             
-            # Load the current LoRA
-            lora_path = folder_paths.get_full_path("loras", lora_name)
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
             print(f"[Info] CR_CycleLoRAs: Current LoRA is {lora_name}")
 
             # Apply the current LoRA to the model and clip
-            model_lora, clip_lora = comfy.sd.load_lora_for_models(
-            model, clip, lora, model_strength, clip_strength)
+            model_lora, clip_lora = apply_lora(model, clip, lora_name, model_strength, clip_strength)
             return (model_lora, clip_lora, show_help, )
         else:
             return (model, clip, show_help, )
@@ -7,7 +7,8 @@ import comfy.sd
 import os
 import sys
 import folder_paths
-from nodes import LoraLoader
+from .functions_lora import apply_lora
+from .functions_checkpoint import load_checkpoint, preload_checkpoint
 from .functions_animation import keyframe_scheduler, prompt_scheduler
 from ..categories import icons
 
@@ -357,7 +358,8 @@ class CR_LoadScheduledModels:
                              "schedule_format": (["CR", "Deforum"],)
                 },
                 "optional": {"model_list": ("MODEL_LIST",),
-                            "schedule": ("SCHEDULE",) 
+                            "schedule": ("SCHEDULE",),
+                            "preload_frames": ("INT", {"default": 0, "min": 0, "max": 9999}),
                 },                
         }
  
@@ -366,17 +368,30 @@ class CR_LoadScheduledModels:
     FUNCTION = "schedule"
     CATEGORY = icons.get("Comfyroll/Animation/Schedulers")
 
-    def schedule(self, mode, current_frame, schedule_alias, default_model, schedule_format, model_list=None, schedule=None):
+    # Start loading the first different model scheduled within the next preload_frames frames
+    def preload_next_model(self, schedule, schedule_alias, current_frame, default_model, model_list, current_model, preload_frames):
+        if preload_frames <= 0 or schedule is None or model_list is None:
+            return
+        for frame in range(current_frame + 1, current_frame + preload_frames + 1):
+            params = keyframe_scheduler(schedule, schedule_alias, frame)
+            if params == "":
+                next_model = default_model
+            else:
+                next_model = next((ckpt_name for ckpt_alias, ckpt_name in model_list if ckpt_alias == str(params)), None)
+            if next_model is not None and next_model != current_model:
+                preload_checkpoint(next_model)
+                return
+
+    def schedule(self, mode, current_frame, schedule_alias, default_model, schedule_format, model_list=None, schedule=None, preload_frames=0):
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Scheduler-Nodes#cr-load-scheduled-models"
 
-        #model_name = ""
+        model_name = ""
     
         # Load default Model mode
         if mode == "Load default Model":
-            ckpt_path = folder_paths.get_full_path("checkpoints", default_model)
-            out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+            out = load_checkpoint(default_model, owner=self)
             print(f"[Debug] CR Load Scheduled Models. Loading default model.")    
-            return (out[:3], show_help, )
+            return (*out, show_help, )
         
         # Get params
         params = keyframe_scheduler(schedule, schedule_alias, current_frame)
@@ -384,9 +399,9 @@ class CR_LoadScheduledModels:
         # Handle case where there is no schedule line for a frame 
         if params == "":
             print(f"[Warning] CR Load Scheduled Models. No model specified in schedule for frame {current_frame}. Using default model.")
-            ckpt_path = folder_paths.get_full_path("checkpoints", default_model)
-            out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
-            return (out[:3], show_help, )
+            out = load_checkpoint(default_model, owner=self)
+            self.preload_next_model(schedule, schedule_alias, current_frame, default_model, model_list, default_model, preload_frames)
+            return (*out, show_help, )
         else:
             # Try the params
             try:
@@ -408,11 +423,10 @@ class CR_LoadScheduledModels:
         else:
             print(f"[Info] CR Load Scheduled Models. Model alias {model_alias} matched to {model_name}")
         
-        # Load the new model
-        ckpt_path = folder_paths.get_full_path("checkpoints", model_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
-        print(f"[Info] CR Load Scheduled Models. Loading new checkpoint model {model_name}")
-        return (out[:3], show_help, )
+        # Load the new model, only read from disk the first time each checkpoint is scheduled
+        out = load_checkpoint(model_name, owner=self)
+        self.preload_next_model(schedule, schedule_alias, current_frame, default_model, model_list, model_name, preload_frames)
+        return (*out, show_help, )
  
 #-----------------------------------------------------------------------------------------------------------# 
 class CR_LoadScheduledLoRAs:
@@ -457,7 +471,7 @@ class CR_LoadScheduledLoRAs:
                 return (model, clip, show_help, )
             if strength_model == 0 and strength_clip == 0:
                 return (model, clip, show_help, )                   
-            model, clip = LoraLoader().load_lora(model, clip, default_lora, strength_model, strength_clip)  
+            model, clip = apply_lora(model, clip, default_lora, strength_model, strength_clip)  
             print(f"[Info] CR Load Scheduled LoRAs. Loading default LoRA {lora_name}.")    
             return (model, clip, show_help, )           
         
@@ -468,7 +482,7 @@ class CR_LoadScheduledLoRAs:
         if params == "":
             print(f"[Warning] CR Load Scheduled LoRAs. No LoRA specified in schedule for frame {current_frame}. Using default lora.")
             if default_lora != None:
-                model, clip = LoraLoader().load_lora(model, clip, default_lora, strength_model, strength_clip)
+                model, clip = apply_lora(model, clip, default_lora, strength_model, strength_clip)
             return (model, clip, show_help, )      
         else:
             # Unpack the parameters
@@ -497,7 +511,7 @@ class CR_LoadScheduledLoRAs:
             print(f"[Info] CR Load Scheduled LoRAs. LoRA {lora_name}")
             
         # Load the new LoRA
-        model, clip = LoraLoader().load_lora(model, clip, lora_name, s_strength_model, s_strength_clip)
+        model, clip = apply_lora(model, clip, lora_name, s_strength_model, s_strength_clip)
         print(f"[Debug] CR Load Scheduled LoRAs. Loading new LoRA {lora_name}")
         return (model, clip, show_help, )
  
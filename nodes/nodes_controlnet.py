@@ -10,6 +10,7 @@ import comfy.sd
 import folder_paths
 from nodes import ControlNetApplyAdvanced
 from ..categories import icons
+from .functions_controlnet import load_controlnet, apply_controlnet_stack_batched
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "comfy"))
 
@@ -105,18 +106,15 @@ class CR_ControlNetStack:
             controlnet_list.extend([l for l in controlnet_stack if l[0] != "None"])
         
         if controlnet_1 != "None" and  switch_1 == "On" and image_1 is not None:
-            controlnet_path = folder_paths.get_full_path("controlnet", controlnet_1)
-            controlnet_1 = comfy.controlnet.load_controlnet(controlnet_path)
+            controlnet_1 = load_controlnet(controlnet_1)
             controlnet_list.extend([(controlnet_1, image_1, controlnet_strength_1, start_percent_1, end_percent_1)]),
 
         if controlnet_2 != "None" and  switch_2 == "On" and image_2 is not None:
-            controlnet_path = folder_paths.get_full_path("controlnet", controlnet_2)
-            controlnet_2 = comfy.controlnet.load_controlnet(controlnet_path)
+            controlnet_2 = load_controlnet(controlnet_2)
             controlnet_list.extend([(controlnet_2, image_2, controlnet_strength_2, start_percent_2, end_percent_2)]),
 
         if controlnet_3 != "None" and  switch_3 == "On" and image_3 is not None:
-            controlnet_path = folder_paths.get_full_path("controlnet", controlnet_3)
-            controlnet_3 = comfy.controlnet.load_controlnet(controlnet_path)
+            controlnet_3 = load_controlnet(controlnet_3)
             controlnet_list.extend([(controlnet_3, image_3, controlnet_strength_3, start_percent_3, end_percent_3)]),
 
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/ControlNet-Nodes#cr-multi-controlnet-stack"
@@ -133,6 +131,9 @@ class CR_ApplyControlNetStack:
                              "base_negative": ("CONDITIONING",),
                              "switch": (["Off","On"],),
                              "controlnet_stack": ("CONTROL_NET_STACK", ),
+                            },
+                "optional": {"apply_mode": (["Sequential", "Batched"],),
+                             "latent": ("LATENT", ),
                             }
         }                    
 
@@ -141,19 +142,30 @@ class CR_ApplyControlNetStack:
     FUNCTION = "apply_controlnet_stack"
     CATEGORY = icons.get("Comfyroll/ControlNet")
 
-    def apply_controlnet_stack(self, base_positive, base_negative, switch, controlnet_stack=None,):
+    def apply_controlnet_stack(self, base_positive, base_negative, switch, controlnet_stack=None, apply_mode="Sequential", latent=None):
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/ControlNet-Nodes#cr-apply-multi-controlnet-stack"
 
         if switch == "Off":
             return (base_positive, base_negative, show_help, )
+
+        # Attach the whole stack in one pass, preparing each distinct hint once
+        if apply_mode == "Batched" and controlnet_stack is not None:
+            # Hints are prepared for the latent's size, scaled up by each ControlNet's own compression ratio
+            latent_size = tuple(latent["samples"].shape[-2:]) if latent is not None else None
+            base_positive, base_negative, stats = apply_controlnet_stack_batched(base_positive, base_negative, controlnet_stack, latent_size)
+            if stats["hints_prepared"] > 0:
+                # Reused hints are estimated to cost the average time of a prepared one
+                saved_seconds = stats["hints_reused"] * stats["prepare_seconds"] / stats["hints_prepared"]
+                print(f"[Info] CR Apply Multi-ControlNet: {stats['hints_prepared']} hints prepared in {stats['prepare_seconds']:.3f}s for {stats['controlnets']} ControlNets, "
+                      f"{stats['hints_reused']} shared, saving about {saved_seconds:.3f}s")
+            return (base_positive, base_negative, show_help, )
     
         if controlnet_stack is not None:
             for controlnet_tuple in controlnet_stack:
                 controlnet_name, image, strength, start_percent, end_percent  = controlnet_tuple
                 
                 if type(controlnet_name) == str:
-                    controlnet_path = folder_paths.get_full_path("controlnet", controlnet_name)
-                    controlnet = comfy.sd.load_controlnet(controlnet_path)
+                    controlnet = load_controlnet(controlnet_name)
                 else:
                     controlnet = controlnet_name
                 
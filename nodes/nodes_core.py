@@ -20,6 +20,9 @@ from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 from pathlib import Path
 from ..categories import icons
+from .functions_checkpoint import load_checkpoint
+from .functions_image_writer import image_writer, save_reserved_image
+from .functions_filename_counter import filename_counters
 
 #---------------------------------------------------------------------------------------------------------------------#
 # Core Nodes
@@ -44,6 +47,7 @@ class CR_ImageOutput:
                 "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
                 "optional": 
                     {"trigger": ("BOOLEAN", {"default": False},),
+                     "background_write": (["Off", "On"],),
                     }
                 }
 
@@ -54,18 +58,18 @@ class CR_ImageOutput:
     CATEGORY = icons.get("Comfyroll/Essential/Core")
 
     def save_images(self, images, file_format, prefix_presets, filename_prefix="CR",
-        trigger=False, output_type="Preview", prompt=None, extra_pnginfo=None):
+        trigger=False, output_type="Preview", prompt=None, extra_pnginfo=None, background_write="Off"):
               
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Core-Nodes#cr-image-output"
     
-        def map_filename(filename):
-            prefix_len = len(os.path.basename(filename_prefix))
-            prefix = filename[:prefix_len + 1]
+        # Counter of a file saved with this prefix, or None for other files
+        def map_filename(name):
+            if name[:len(filename) + 1] != filename + "_":
+                return None
             try:
-                digits = int(filename[prefix_len + 1:].split('_')[0])
-            except:
-                digits = 0
-            return (digits, prefix)
+                return int(name[len(filename) + 1:].split('_')[0])
+            except ValueError:
+                return 0
 
         if output_type == "Save":
             self.output_dir = folder_paths.get_output_directory()
@@ -97,13 +101,7 @@ class CR_ImageOutput:
         if os.path.commonpath((self.output_dir, os.path.abspath(full_output_folder))) != self.output_dir:
             return {}
 
-        try:
-            counter = max(filter(lambda a: a[1][:-1] == filename and a[1][-1] == "_", map(map_filename, os.listdir(full_output_folder))))[0] + 1
-        except ValueError:
-            counter = 1
-        except FileNotFoundError:
-            os.makedirs(full_output_folder, exist_ok=True)
-            counter = 1
+        os.makedirs(full_output_folder, exist_ok=True)
 
         if output_type == "UI (no batch)":
             # based on ETN_SendImageWebSocket
@@ -126,7 +124,7 @@ class CR_ImageOutput:
             results = list()
             for image in images:
                 i = 255. * image.cpu().numpy()
-                img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+                array = np.clip(i, 0, 255).astype(np.uint8)
                 metadata = PngInfo()
                 if prompt is not None:
                     metadata.add_text("prompt", json.dumps(prompt))
@@ -134,6 +132,9 @@ class CR_ImageOutput:
                     for x in extra_pnginfo:
                         metadata.add_text(x, json.dumps(extra_pnginfo[x]))
 
+                # Reserve the next free file name, the counter index avoids listing the folder on every save
+                counter = filename_counters.reserve(full_output_folder, ("image_output", filename), map_filename,
+                                                    lambda c: f"{filename}_{c:05}_.{file_format}")
                 file_name = f"{filename}_{counter:05}_.{file_format}"
                 
                 img_params = {'png': {'compress_level': 4}, 
@@ -144,13 +145,17 @@ class CR_ImageOutput:
                 
                 resolved_image_path = os.path.join(full_output_folder, file_name)
                 
-                img.save(resolved_image_path, **img_params[file_format], pnginfo=metadata)
+                if background_write == "On":
+                    # The writer owns the array from here, encoding happens on its threads
+                    image_writer.submit(array, resolved_image_path, dict(img_params[file_format], pnginfo=metadata))
+                else:
+                    img = Image.fromarray(array)
+                    save_reserved_image(img, resolved_image_path, dict(img_params[file_format], pnginfo=metadata))
                 results.append({
                     "filename": file_name,
                     "subfolder": subfolder,
                     "type": self.type
                 })
-                counter += 1
 
             return { "ui": { "images": results }, "result": (trigger, show_help,) }
  
@@ -371,9 +376,7 @@ class CR_SelectModel:
             print(f"CR Select Model: No model selected")
             return()
 
-        ckpt_path = folder_paths.get_full_path("checkpoints", model_name)
-        model, clip, vae, clipvision = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True,
-                                                     embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        model, clip, vae = load_checkpoint(model_name, owner=self)
             
         return (model, clip, vae, model_name, show_help, )
 
@@ -9,8 +9,11 @@ import comfy.sd
 import comfy.utils
 import folder_paths
 import hashlib
-from random import random, uniform
+from random import Random
 from ..categories import icons
+from ..config import RANDOM_LORA_STATE_ITEMS, RANDOM_LORA_STATE_TTL
+from .functions_cache import LRUCache
+from .functions_lora import apply_lora, apply_lora_stack_fused, apply_lora_scaled, prefetch_lora_stack
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "comfy"))
 
@@ -19,8 +22,6 @@ sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "co
 #---------------------------------------------------------------------------------------------------------------------#
 # This is a load lora node with an added switch to turn on or off.  On will add the lora and off will skip the node.
 class CR_LoraLoader:
-    def __init__(self):
-        self.loaded_lora = None
 
     @classmethod
     def INPUT_TYPES(s):
@@ -34,13 +35,16 @@ class CR_LoraLoader:
                               "lora_name": (file_list, ),
                               "strength_model": ("FLOAT", {"default": 1.0, "min": -10.0, "max": 10.0, "step": 0.01}),
                               "strength_clip": ("FLOAT", {"default": 1.0, "min": -10.0, "max": 10.0, "step": 0.01}),
-                              }}
+                              },
+                "optional": {"lazy_load": (["Off","On"],),
+                             "strength_mode": (["Patch","Scaled Delta"],),
+                            }}
     RETURN_TYPES = ("MODEL", "CLIP", "STRING", )
     RETURN_NAMES = ("MODEL", "CLIP", "show_help", )
     FUNCTION = "load_lora"
     CATEGORY = icons.get("Comfyroll/LoRA")
 
-    def load_lora(self, model, clip, switch, lora_name, strength_model, strength_clip):
+    def load_lora(self, model, clip, switch, lora_name, strength_model, strength_clip, lazy_load="Off", strength_mode="Patch"):
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/LoRA-Nodes#cr-load-lora"
         if strength_model == 0 and strength_clip == 0:
             return (model, clip, show_help, )
@@ -48,19 +52,12 @@ class CR_LoraLoader:
         if switch == "Off" or  lora_name == "None":
             return (model, clip, show_help, )
 
-        lora_path = folder_paths.get_full_path("loras", lora_name)
-        lora = None
-        if self.loaded_lora is not None:
-            if self.loaded_lora[0] == lora_path:
-                lora = self.loaded_lora[1]
-            else:
-                del self.loaded_lora
+        # Reuse the delta computed once per base model, for strength sweeps
+        if strength_mode == "Scaled Delta":
+            model_lora, clip_lora = apply_lora_scaled(model, clip, lora_name, strength_model, strength_clip)
+            return (model_lora, clip_lora, show_help, )
 
-        if lora is None:
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-            self.loaded_lora = (lora_path, lora)
-
-        model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
+        model_lora, clip_lora = apply_lora(model, clip, lora_name, strength_model, strength_clip, lazy_load == "On")
         return (model_lora, clip_lora, show_help, )
 
 #---------------------------------------------------------------------------------------------------------------------#
@@ -115,6 +112,9 @@ class CR_LoRAStack:
            
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/LoRA-Nodes#cr-lora-stack"           
 
+        # Start reading the files while the rest of the graph runs
+        prefetch_lora_stack(lora_list)
+
         return (lora_list, show_help, )
 
 #---------------------------------------------------------------------------------------------------------------------#
@@ -126,6 +126,9 @@ class CR_ApplyLoRAStack:
         return {"required": {"model": ("MODEL",),
                             "clip": ("CLIP", ),
                             "lora_stack": ("LORA_STACK", ),
+                            },
+                "optional": {"lazy_load": (["Off","On"],),
+                             "apply_mode": (["Sequential","Fused"],),
                             }
         }
 
@@ -134,7 +137,7 @@ class CR_ApplyLoRAStack:
     FUNCTION = "apply_lora_stack"
     CATEGORY = icons.get("Comfyroll/LoRA")
 
-    def apply_lora_stack(self, model, clip, lora_stack=None,):
+    def apply_lora_stack(self, model, clip, lora_stack=None, lazy_load="Off", apply_mode="Sequential"):
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/LoRA-Nodes#cr-apply-lora-stack"
 
         # Initialise the list
@@ -146,6 +149,14 @@ class CR_ApplyLoRAStack:
         else:
             return (model, clip, show_help,)
 
+        if lazy_load != "On":
+            prefetch_lora_stack(lora_params)
+
+        # Apply the whole stack to one clone, reused while the stack and base model are unchanged
+        if apply_mode == "Fused":
+            model_lora, clip_lora = apply_lora_stack_fused(model, clip, lora_params, lazy_load == "On")
+            return (model_lora, clip_lora, show_help,)
+
         # Initialise the model and clip
         model_lora = model
         clip_lora = clip
@@ -154,10 +165,7 @@ class CR_ApplyLoRAStack:
         for tup in lora_params:
             lora_name, strength_model, strength_clip = tup
             
-            lora_path = folder_paths.get_full_path("loras", lora_name)
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-            
-            model_lora, clip_lora = comfy.sd.load_lora_for_models(model_lora, clip_lora, lora, strength_model, strength_clip)  
+            model_lora, clip_lora = apply_lora(model_lora, clip_lora, lora_name, strength_model, strength_clip, lazy_load == "On")  
 
         return (model_lora, clip_lora, show_help,)
 
@@ -180,7 +188,8 @@ class CR_RandomWeightLoRA:
                     "weight_max": ("FLOAT", {"default": 1.0, "min": -10.0, "max": 10.0, "step": 0.01}),
                     "clip_weight": ("FLOAT", {"default": 1.0, "min": -10.0, "max": 10.0, "step": 0.01}),
                 },
-                "optional": {"lora_stack": ("LORA_STACK",)
+                "optional": {"lora_stack": ("LORA_STACK",),
+                             "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
                 },
         }
 
@@ -188,9 +197,17 @@ class CR_RandomWeightLoRA:
     FUNCTION = "random_weight_lora"
     CATEGORY = icons.get("Comfyroll/LoRA")
 
-    LastWeightMap = {}
-    StridesMap = {}
-    LastHashMap = {}
+    # Stride count, last weight and a private RNG per seed and id hash, bounded and expired when unused
+    StateStore = LRUCache("random weight lora state", None, max_items=RANDOM_LORA_STATE_ITEMS, sizeof=lambda state: 0, ttl=RANDOM_LORA_STATE_TTL)
+
+    @staticmethod
+    def getState(seed, id_hash):
+        state = CR_RandomWeightLoRA.StateStore.get((seed, id_hash))
+        if state is None:
+            # String seeds are hashed with sha512, so every worker draws the same sequence
+            state = {"rng": Random(f"{seed}_{id_hash}"), "strides": 0, "last_hash": None, "last_weight": None}
+            CR_RandomWeightLoRA.StateStore.put((seed, id_hash), state)
+        return state
 
     @staticmethod
     def getIdHash(lora_name: str, force_randomize_after_stride, stride, weight_min, weight_max, clip_weight) -> int:
@@ -198,7 +215,7 @@ class CR_RandomWeightLoRA:
         return hashlib.sha256(fl_str.encode('utf-8')).hexdigest()
 
     @classmethod
-    def IS_CHANGED(cls, stride, force_randomize_after_stride, lora_name, switch, weight_min, weight_max, clip_weight, lora_stack=None):     
+    def IS_CHANGED(cls, stride, force_randomize_after_stride, lora_name, switch, weight_min, weight_max, clip_weight, lora_stack=None, seed=0):     
         id_hash = CR_RandomWeightLoRA.getIdHash(lora_name, force_randomize_after_stride, stride, weight_min, weight_max, clip_weight)
 
         if switch == "Off":
@@ -206,30 +223,29 @@ class CR_RandomWeightLoRA:
         if lora_name == "None":
             return id_hash
 
-        if id_hash not in CR_RandomWeightLoRA.StridesMap:
-            CR_RandomWeightLoRA.StridesMap[id_hash] = 0
-
-        CR_RandomWeightLoRA.StridesMap[id_hash] += 1
+        state = CR_RandomWeightLoRA.getState(seed, id_hash)
+        state["strides"] += 1
 
-        if stride > 1 and CR_RandomWeightLoRA.StridesMap[id_hash] < stride and id_hash in CR_RandomWeightLoRA.LastHashMap:
-            return CR_RandomWeightLoRA.LastHashMap[id_hash]
+        if stride > 1 and state["strides"] < stride and state["last_hash"] is not None:
+            return state["last_hash"]
         else:
-            CR_RandomWeightLoRA.StridesMap[id_hash] = 0
+            state["strides"] = 0
 
-        last_weight = CR_RandomWeightLoRA.LastWeightMap.get(id_hash, None)
-        weight = uniform(weight_min, weight_max)
+        rng = state["rng"]
+        last_weight = state["last_weight"]
+        weight = rng.uniform(weight_min, weight_max)
 
-        if last_weight is not None:
+        if last_weight is not None and weight_min != weight_max:
             while weight == last_weight:
-                weight = uniform(weight_min, weight_max)
+                weight = rng.uniform(weight_min, weight_max)
 
-        CR_RandomWeightLoRA.LastWeightMap[id_hash] = weight 
+        state["last_weight"] = weight 
 
         hash_str = f"{id_hash}_{weight:.3f}"
-        CR_RandomWeightLoRA.LastHashMap[id_hash] = hash_str
+        state["last_hash"] = hash_str
         return hash_str
 
-    def random_weight_lora(self, stride, force_randomize_after_stride, lora_name, switch, weight_min, weight_max, clip_weight, lora_stack=None):
+    def random_weight_lora(self, stride, force_randomize_after_stride, lora_name, switch, weight_min, weight_max, clip_weight, lora_stack=None, seed=0):
         id_hash = CR_RandomWeightLoRA.getIdHash(lora_name, force_randomize_after_stride, stride, weight_min, weight_max, clip_weight)
 
         # Initialise the list
@@ -238,7 +254,8 @@ class CR_RandomWeightLoRA:
         if lora_stack is not None:
             lora_list.extend([l for l in lora_stack if l[0] != "None"])
 
-        weight = CR_RandomWeightLoRA.LastWeightMap.get(id_hash, 0.0)
+        state = CR_RandomWeightLoRA.StateStore.get((seed, id_hash))
+        weight = state["last_weight"] if state is not None and state["last_weight"] is not None else 0.0
 
         if lora_name != "None" and switch == "On":
             lora_list.extend([(lora_name, weight, clip_weight)]),
@@ -276,7 +293,8 @@ class CR_RandomLoRAStack:
                     "model_weight_3": ("FLOAT", {"default": 1.0, "min": -10.0, "max": 10.0, "step": 0.01}),
                     "clip_weight_3": ("FLOAT", {"default": 1.0, "min": -10.0, "max": 10.0, "step": 0.01}),
                 },
-                "optional": {"lora_stack": ("LORA_STACK",)
+                "optional": {"lora_stack": ("LORA_STACK",),
+                             "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
                 },
         }
 
@@ -284,15 +302,23 @@ class CR_RandomLoRAStack:
     FUNCTION = "random_lora_stacker"
     CATEGORY = icons.get("Comfyroll/LoRA")
 
-    UsedLorasMap = {}
-    StridesMap = {}
-    LastHashMap = {}
+    # Stride count, used loras and a private RNG per seed and id hash, bounded and expired when unused
+    StateStore = LRUCache("random lora stack state", None, max_items=RANDOM_LORA_STATE_ITEMS, sizeof=lambda state: 0, ttl=RANDOM_LORA_STATE_TTL)
 
+    # Stable across processes, unlike hash() of strings
     @staticmethod
-    def getIdHash(lora_name_1: str, lora_name_2: str, lora_name_3: str) -> int:
+    def getIdHash(lora_name_1: str, lora_name_2: str, lora_name_3: str) -> str:
         id_set = set([lora_name_1, lora_name_2, lora_name_3])
-        id_hash = hash(frozenset(id_set))
-        return id_hash
+        return hashlib.sha256("|".join(sorted(id_set)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def getState(seed, id_hash):
+        state = CR_RandomLoRAStack.StateStore.get((seed, id_hash))
+        if state is None:
+            # String seeds are hashed with sha512, so every worker draws the same sequence
+            state = {"rng": Random(f"{seed}_{id_hash}"), "strides": 0, "last_hash": None, "used_loras": set()}
+            CR_RandomLoRAStack.StateStore.put((seed, id_hash), state)
+        return state
 
     @staticmethod
     def deduplicateLoraNames(lora_name_1: str, lora_name_2: str, lora_name_3: str):
@@ -332,21 +358,21 @@ class CR_RandomLoRAStack:
 
     @classmethod
     def IS_CHANGED(cls, exclusive_mode, stride, force_randomize_after_stride, lora_name_1, model_weight_1, clip_weight_1, switch_1, chance_1, lora_name_2,
-                    model_weight_2, clip_weight_2, switch_2, chance_2, lora_name_3, model_weight_3, clip_weight_3, switch_3, chance_3, lora_stack=None):     
+                    model_weight_2, clip_weight_2, switch_2, chance_2, lora_name_3, model_weight_3, clip_weight_3, switch_3, chance_3, lora_stack=None, seed=0):     
         lora_set = set()
 
         lora_name_1, lora_name_2, lora_name_3 = CR_RandomLoRAStack.deduplicateLoraNames(lora_name_1, lora_name_2, lora_name_3)        
         id_hash = CR_RandomLoRAStack.getIdHash(lora_name_1, lora_name_2, lora_name_3)
 
-        if id_hash not in CR_RandomLoRAStack.StridesMap:
-            CR_RandomLoRAStack.StridesMap[id_hash] = 0
-
-        CR_RandomLoRAStack.StridesMap[id_hash] += 1
+        state = CR_RandomLoRAStack.getState(seed, id_hash)
+        state["strides"] += 1
 
-        if stride > 1 and CR_RandomLoRAStack.StridesMap[id_hash] < stride and id_hash in CR_RandomLoRAStack.LastHashMap:
-            return CR_RandomLoRAStack.LastHashMap[id_hash]
+        if stride > 1 and state["strides"] < stride and state["last_hash"] is not None:
+            return state["last_hash"]
         else:
-            CR_RandomLoRAStack.StridesMap[id_hash] = 0
+            state["strides"] = 0
+
+        rng = state["rng"]
 
         total_on = 0
         if lora_name_1 != "None" and switch_1 == "On" and chance_1 > 0.0: total_on += 1
@@ -356,9 +382,9 @@ class CR_RandomLoRAStack:
         def perform_randomization() -> set:    
             _lora_set = set()
 
-            rand_1 = random()
-            rand_2 = random()
-            rand_3 = random()
+            rand_1 = rng.random()
+            rand_2 = rng.random()
+            rand_3 = rng.random()
 
             apply_1 = True if (rand_1 <= chance_1 and switch_1 == "On") else False
             apply_2 = True if (rand_2 <= chance_2 and switch_2 == "On") else False
@@ -390,21 +416,21 @@ class CR_RandomLoRAStack:
                 _lora_set.add(lora_name_3)
             return _lora_set
 
-        last_lora_set = CR_RandomLoRAStack.UsedLorasMap.get(id_hash, set())
+        last_lora_set = state["used_loras"]
         lora_set = perform_randomization()
 
         if force_randomize_after_stride == "On" and len(last_lora_set) > 0 and total_on > 1:
             while lora_set == last_lora_set:
                 lora_set = perform_randomization()
 
-        CR_RandomLoRAStack.UsedLorasMap[id_hash] = lora_set        
+        state["used_loras"] = lora_set        
 
-        hash_str = str(hash(frozenset(lora_set)))
-        CR_RandomLoRAStack.LastHashMap[id_hash] = hash_str
+        hash_str = hashlib.sha256("|".join(sorted(lora_set)).encode('utf-8')).hexdigest()
+        state["last_hash"] = hash_str
         return hash_str
 
     def random_lora_stacker(self, exclusive_mode, stride, force_randomize_after_stride, lora_name_1, model_weight_1, clip_weight_1, switch_1, chance_1, lora_name_2,
-                    model_weight_2, clip_weight_2, switch_2, chance_2, lora_name_3, model_weight_3, clip_weight_3, switch_3, chance_3, lora_stack=None):
+                    model_weight_2, clip_weight_2, switch_2, chance_2, lora_name_3, model_weight_3, clip_weight_3, switch_3, chance_3, lora_stack=None, seed=0):
 
         # Initialise the list
         lora_list=list()
@@ -415,7 +441,8 @@ class CR_RandomLoRAStack:
         lora_name_1, lora_name_2, lora_name_3 = CR_RandomLoRAStack.deduplicateLoraNames(lora_name_1, lora_name_2, lora_name_3)
         id_hash = CR_RandomLoRAStack.getIdHash(lora_name_1, lora_name_2, lora_name_3)
 
-        used_loras = CR_RandomLoRAStack.UsedLorasMap.get(id_hash, set())
+        state = CR_RandomLoRAStack.StateStore.get((seed, id_hash))
+        used_loras = state["used_loras"] if state is not None else set()
 
         if lora_name_1 != "None" and switch_1 == "On" and lora_name_1 in used_loras:
             lora_list.extend([(CR_RandomLoRAStack.cleanLoraName(lora_name_1), model_weight_1, clip_weight_1)]),
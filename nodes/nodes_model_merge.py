@@ -3,10 +3,13 @@
 # for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI                                               
 #---------------------------------------------------------------------------------------------------------------------#
 
+import time
 import comfy.sd
 import comfy.model_management
 import folder_paths
 from ..categories import icons
+from .functions_checkpoint import load_checkpoint, load_checkpoint_parts
+from .functions_model_merge import merge_ratios, single_pass_patches, stream_merge, load_merged_state_dict, load_merged_checkpoint, get_merge_disk_cache, merge_recipe_key, save_merged_checkpoint
 
 #---------------------------------------------------------------------------------------------------------------------#                        
 # Model Merge Nodes
@@ -76,6 +79,9 @@ class CR_ApplyModelMerge:
                              "merge_method": (merge_methods,),
                              "normalise_ratios": (["Yes","No"],),
                              "weight_factor":("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                            },
+                "optional": {"merge_engine": (["Patch", "Single Pass", "Streaming"],),
+                             "merge_cache": (["Off", "Disk"],),
                             }
         }
         
@@ -84,11 +90,11 @@ class CR_ApplyModelMerge:
     FUNCTION = "merge"
     CATEGORY = icons.get("Comfyroll/Model Merge")
 
-    def merge(self, model_stack, merge_method, normalise_ratios, weight_factor):
+    def merge(self, model_stack, merge_method, normalise_ratios, weight_factor, merge_engine="Patch", merge_cache="Off"):
     
+        show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Model-Merge-Nodes#cr-apply-model-merge"
+
         # Initialise
-        sum_clip_ratio = 0
-        sum_model_ratio = 0
         model_mix_info = str("Merge Info:\n")
              
         # If no models
@@ -100,67 +106,135 @@ class CR_ApplyModelMerge:
         if len(model_stack) == 1:
             print(f"[Warning] Apply Model Merge: Only one active model found in the model merge stack. At least 2 models are normally needed for merging. The active model will be output.")
             model_name, model_ratio, clip_ratio = model_stack[0]
-            ckpt_path = folder_paths.get_full_path("checkpoints", model_name)
-            return comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+            model, clip, vae = load_checkpoint(model_name)
+            return (model, clip, model_mix_info, show_help, )
         
-        # Calculate ratio sums for normalisation        
-        for i, model_tuple in enumerate(model_stack):
-            model_name, model_ratio, clip_ratio = model_tuple
-            sum_model_ratio += model_ratio                
-            sum_clip_ratio += clip_ratio
+        # Normalise the ratios and apply the merge method
+        sum_model_ratio = sum(model_tuple[1] for model_tuple in model_stack)
+        if sum_model_ratio != 1 and normalise_ratios == "Yes":
+            print(f"[Warning] Apply Model Merge: Sum of model ratios != 1. Ratios will be normalised")
+        ratios = merge_ratios(model_stack, merge_method, normalise_ratios, weight_factor)
    
         # Do recursive merge loops
         model_mix_info = model_mix_info + "Ratios are applied using the Recursive method\n\n"
         
-        # Loop through the models and compile the merged model
         for i, model_tuple in enumerate(model_stack):
             model_name, model_ratio, clip_ratio = model_tuple
-            ckpt_path = folder_paths.get_full_path("checkpoints", model_name)
-            merge_model = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
             print(f"Apply Model Merge: Model Name {model_name}, Model Ratio {model_ratio}, CLIP Ratio {clip_ratio}")
+            model_name, model_ratio, clip_ratio = ratios[i]
+            if i == 0:
+                model_mix_info = model_mix_info + "Base Model Name: " + model_name
+            else:
+                model_mix_info = model_mix_info + "\nModel Name: " + model_name + "\nModel Ratio: " + str(model_ratio) + "\nCLIP Ratio: " + str(clip_ratio) + "\n"
+
+        # Load a previous merge of the same recipe
+        if merge_cache == "Disk":
+            disk_cache = get_merge_disk_cache()
+            merge_key = merge_recipe_key(model_stack, merge_method, normalise_ratios, weight_factor)
+            cached_path = disk_cache.get_path(merge_key)
+            if cached_path is not None:
+                print(f"[Info] Apply Model Merge: Loading cached merge {merge_key}")
+                model1, clip1 = load_merged_checkpoint(cached_path)
+                model_mix_info = model_mix_info + f"\nLoaded from merge cache: {merge_key}\n"
+                return (model1, clip1, model_mix_info, show_help, )
+
+        if merge_engine == "Streaming":
+            ckpt_paths = [folder_paths.get_full_path("checkpoints", model_name) for model_name, _, _ in ratios]
+            if not all(path.endswith(".safetensors") for path in ckpt_paths):
+                print(f"[Warning] Apply Model Merge: Streaming merge needs safetensors checkpoints. Using the Patch engine.")
+                merge_engine = "Patch"
+
+        # Streaming merge of safetensors checkpoints, one key at a time
+        if merge_engine == "Streaming":
+            start_time = time.perf_counter()
+            merged, stats = stream_merge(ckpt_paths, [r[1] for r in ratios], [r[2] for r in ratios])
+            model1, clip1 = load_merged_state_dict(merged)
+            del merged
+            model_mix_info = model_mix_info + f"\nStreaming merge: {stats['keys_merged']} keys merged, {sum(stats['bytes_read']) / 1024 ** 3:.2f} GB read in {time.perf_counter() - start_time:.1f}s\n"
+            model_mix_info = model_mix_info + self.bytes_skipped_info(ratios, stats["bytes_skipped"])
+
+        # Single pass merge, one patch per key with the stack folded into per model coefficients
+        elif merge_engine == "Single Pass":
+            checkpoints = self.load_merge_checkpoints(ratios)
+            start_time = time.perf_counter()
+            model1 = checkpoints[0][0].clone()
+            clip1 = checkpoints[0][1].clone()
+            # Models left unloaded have a ratio of 0, which leaves the other coefficients unchanged
+            model_inputs = [(c[0], r[1]) for c, r in zip(checkpoints, ratios) if c[0] is not None]
+            clip_inputs = [(c[1].patcher, r[2]) for c, r in zip(checkpoints, ratios) if c[1] is not None]
+            model_patches = single_pass_patches([m for m, _ in model_inputs], [r for _, r in model_inputs], "diffusion_model.")
+            clip_patches = single_pass_patches([c for c, _ in clip_inputs], [r for _, r in clip_inputs],
+                                               skip_suffixes=(".position_ids", ".logit_scale"))
+            model1.add_patches(model_patches, 1.0, 0.0)
+            clip1.add_patches(clip_patches, 1.0, 0.0)
+            patch_count = len(model_patches) + len(clip_patches)
+            model_mix_info = model_mix_info + f"\nSingle pass merge: {patch_count} patches in {time.perf_counter() - start_time:.2f}s\n"
+            model_mix_info = model_mix_info + self.bytes_skipped_info(ratios, [c[2]["bytes_skipped"] for c in checkpoints])
+
+        else:
+            checkpoints = self.load_merge_checkpoints(ratios)
+            model1, clip1, patch_count, patch_time = self.patch_merge(ratios, checkpoints)
+            model_mix_info = model_mix_info + f"\nPatch merge: {patch_count} patches in {patch_time:.2f}s\n"
+            model_mix_info = model_mix_info + self.bytes_skipped_info(ratios, [c[2]["bytes_skipped"] for c in checkpoints])
+
+        # Save the merge for later runs of the same recipe
+        if merge_cache == "Disk":
+            disk_cache.put_file(merge_key, lambda path: save_merged_checkpoint(path, model1, clip1))
+            print(f"[Info] Apply Model Merge: Saved merge {merge_key} to the merge cache")
 
-            if sum_model_ratio != 1 and normalise_ratios == "Yes":
-                print(f"[Warning] Apply Model Merge: Sum of model ratios != 1. Ratios will be normalised")
-                # Normalise the ratios  
-                model_ratio = round(model_ratio / sum_model_ratio, 2)
-                clip_ratio = round(clip_ratio / sum_clip_ratio, 2)
-            
-            # Weighted merge method
-            if merge_method == "Weighted":
-                if i == 1:
-                    # Reassign extra weight to the second model
-                    model_ratio = 1 - weight_factor + (weight_factor * model_ratio)
-                    clip_ratio = 1 - weight_factor + (weight_factor * clip_ratio)
+        return (model1, clip1, model_mix_info, show_help, )
+
+    # Load the parts of each checkpoint the merge uses. The base model needs its UNet and CLIP, the others only the
+    # parts with a non-zero ratio. No VAE is loaded.
+    def load_merge_checkpoints(self, ratios):
+        checkpoints = list()
+        for i, (model_name, model_ratio, clip_ratio) in enumerate(ratios):
+            checkpoints.append(load_checkpoint_parts(model_name, output_model=(i == 0 or model_ratio != 0),
+                                                     output_clip=(i == 0 or clip_ratio != 0)))
+        return checkpoints
+
+    def bytes_skipped_info(self, ratios, bytes_skipped):
+        info = "\nBytes skipped:\n"
+        for (model_name, _, _), nbytes in zip(ratios, bytes_skipped):
+            info = info + f"{model_name}: {nbytes / 1024 ** 3:.2f} GB\n"
+        return info
+
+    def patch_merge(self, ratios, checkpoints):
+        patch_count = 0
+        patch_time = 0
+
+        # Loop through the models and compile the merged model
+        for i, model_tuple in enumerate(ratios):
+            model_name, model_ratio, clip_ratio = model_tuple
+            merge_model = checkpoints[i]
                       
             #Clone the first model
             if i == 0: 
                 model1 = merge_model[0].clone()
                 clip1 = merge_model[1].clone()
-                
-                model_mix_info = model_mix_info + "Base Model Name: " + model_name
             else:
+                start_time = time.perf_counter()
                 # Merge next model
                 # Comfy merge logic is flipped for stacked nodes. This is because the first model is effectively model1 and all subsequent models are model2. 
-                model2 = merge_model[0].clone()
-                kp = model2.get_key_patches("diffusion_model.")
+                # A part that was not loaded has a ratio of 0, and a patch at 0 leaves the weights unchanged
+                model2 = merge_model[0].clone() if merge_model[0] is not None else None
+                kp = model2.get_key_patches("diffusion_model.") if model2 is not None else {}
                 for k in kp:
                     #model1.add_patches({k: kp[k]}, 1.0 - model_ratio, model_ratio) #original logic
                     model1.add_patches({k: kp[k]}, model_ratio, 1.0 - model_ratio) #flipped logic
+                patch_count += len(kp)
                 # Merge next clip
-                clip2 = merge_model[1].clone()          
-                kp = clip2.get_key_patches()
+                clip2 = merge_model[1].clone() if merge_model[1] is not None else None
+                kp = clip2.get_key_patches() if clip2 is not None else {}
                 for k in kp:
                     if k.endswith(".position_ids") or k.endswith(".logit_scale"):
                         continue
                     #clip1.add_patches({k: kp[k]}, 1.0 - clip_ratio, clip_ratio) #original logic
                     clip1.add_patches({k: kp[k]}, clip_ratio, 1.0 - clip_ratio) #flipped logic
-            
-            # Update model info                
-                model_mix_info = model_mix_info + "\nModel Name: " + model_name + "\nModel Ratio: " + str(model_ratio) + "\nCLIP Ratio: " + str(clip_ratio) + "\n"
+                    patch_count += 1
+                patch_time += time.perf_counter() - start_time
 
-        show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Model-Merge-Nodes#cr-apply-model-merge"
-                
-        return (model1, clip1, model_mix_info, show_help, )
+        return model1, clip1, patch_count, patch_time
 
 #---------------------------------------------------------------------------------------------------------------------#
 # MAPPINGS
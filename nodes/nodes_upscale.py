@@ -9,6 +9,7 @@ import folder_paths
 from PIL import Image
 from ..categories import icons
 from .functions_upscale import *
+from .functions_cache import object_nbytes
 
 #MAX_RESOLUTION=8192
 
@@ -31,9 +32,16 @@ class CR_UpscaleImage:
                      "rescale_factor": ("FLOAT", {"default": 2, "min": 0.01, "max": 16.0, "step": 0.01}),
                      "resize_width": ("INT", {"default": 1024, "min": 1, "max": 48000, "step": 1}),
                      "resampling_method": (resampling_methods,),                     
-                     "supersample": (["true", "false"],),   
+                     "supersample": (["true", "false", "legacy"],),   
                      "rounding_modulus": ("INT", {"default": 8, "min": 8, "max": 1024, "step": 8}),
-                     }
+                     },
+                "optional":
+                    {"max_tile_memory_mb": ("INT", {"default": 0, "min": 0, "max": 1048576, "step": 64}),
+                     "resize_engine": (["pil", "torch"],),
+                     "result_cache": (["Off", "Memory", "Memory + Disk"],),
+                     "cpu_workers": ("INT", {"default": 0, "min": 0, "max": 256, "step": 1}),
+                     "cpu_threads_per_worker": ("INT", {"default": 1, "min": 1, "max": 256, "step": 1}),
+                    }
                 }
 
     RETURN_TYPES = ("IMAGE", "STRING", )
@@ -41,35 +49,32 @@ class CR_UpscaleImage:
     FUNCTION = "upscale"
     CATEGORY = icons.get("Comfyroll/Upscale")
     
-    def upscale(self, image, upscale_model, rounding_modulus=8, loops=1, mode="rescale", supersample='true', resampling_method="lanczos", rescale_factor=2, resize_width=1024):
+    def upscale(self, image, upscale_model, rounding_modulus=8, loops=1, mode="rescale", supersample='true', resampling_method="lanczos", rescale_factor=2, resize_width=1024, max_tile_memory_mb=0, resize_engine="pil", result_cache="Off", cpu_workers=0, cpu_threads_per_worker=1):
 
-        # Load upscale model 
-        up_model = load_model(upscale_model)
+        show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Upscale-Nodes#cr-upscale-image"
 
-        # Upscale with model
-        up_image = upscale_with_model(up_model, image)  
+        def run_upscale():
+            # Load upscale model 
+            up_model = load_model(upscale_model)
 
-        for img in image:
-            pil_img = tensor2pil(img)
-            original_width, original_height = pil_img.size
+            # Upscale with model
+            up_image = upscale_with_model(up_model, image, max_tile_memory_mb, cpu_workers, cpu_threads_per_worker)  
 
-        for img in up_image:
-            # Get new size
-            pil_img = tensor2pil(img)
-            upscaled_width, upscaled_height = pil_img.size
+            original_height, original_width = image.shape[1], image.shape[2]
+            upscaled_width = up_image.shape[2]
 
-        show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Upscale-Nodes#cr-upscale-image"
+            # Return if no rescale needed
+            if upscaled_width == original_width and rescale_factor == 1:
+                return up_image
+                  
+            # Image resize
+            return apply_resize_batch(up_image, original_width, original_height, rounding_modulus, mode, supersample, rescale_factor, resize_width, resampling_method, resize_engine)
 
-        # Return if no rescale needed
-        if upscaled_width == original_width and rescale_factor == 1:
-            return (up_image, show_help)
-              
-        # Image resize
-        scaled_images = []
-        
-        for img in up_image:
-            scaled_images.append(pil2tensor(apply_resize_image(tensor2pil(img), original_width, original_height, rounding_modulus, mode, supersample, rescale_factor, resize_width, resampling_method)))
-        images_out = torch.cat(scaled_images, dim=0)
+        if result_cache == "Off":
+            images_out = run_upscale()
+        else:
+            key = upscale_result_key(image, [upscale_model], mode, rescale_factor, resize_width, resampling_method, supersample, rounding_modulus, resize_engine)
+            images_out = cached_upscale_result(result_cache, key, run_upscale)
  
         return (images_out, show_help, )        
  
@@ -123,6 +128,81 @@ class CR_MultiUpscaleStack:
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Upscale-Nodes#cr-multi-upscale-stack"
         return (upscale_list, show_help, )
 
+#---------------------------------------------------------------------------------------------------------------------
+class CR_UpscaleStackPlanner:
+
+    @classmethod
+    def INPUT_TYPES(s):
+    
+        return {"required": {"image": ("IMAGE",),
+                             "upscale_stack": ("UPSCALE_STACK",),
+                             "target_width": ("INT", {"default": 2048, "min": 1, "max": 48000, "step": 1}),
+                            },
+                "optional": {"measure": (["Off", "On"],),
+                            }
+        }
+    
+    RETURN_TYPES = ("UPSCALE_STACK", "STRING", "STRING", )
+    RETURN_NAMES = ("UPSCALE_STACK", "plan_info", "show_help", )
+    FUNCTION = "plan"
+    CATEGORY = icons.get("Comfyroll/Upscale")
+
+    # Run a stack on the image with the CR Apply Multi Upscale defaults, returning per stage stats and the peaks
+    def measure_stack(self, image, stack, original_width, original_height):
+        stage_stats = []
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        result, peak_bytes = apply_upscale_stack(image, stack, original_width, original_height, "lanczos", "true", 8, stage_stats=stage_stats)
+        del result
+        device_peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+        return stage_stats, peak_bytes, device_peak
+
+    def stack_info(self, title, stack, costs, measured):
+        info = f"{title}:\n"
+        for i, ((upscale_model, rescale_factor), cost) in enumerate(zip(stack, costs)):
+            info += f"{upscale_model}, rescale {rescale_factor:.4f}, estimated {cost:.2f} MPix"
+            if measured is not None:
+                stats = measured[0][i]
+                info += f", actual {stats['megapixels']:.2f} MPix in {stats['seconds']:.2f}s"
+            info += "\n"
+        info += f"Total estimated {sum(costs):.2f} MPix"
+        if measured is not None:
+            stage_stats, peak_bytes, device_peak = measured
+            info += f", actual {sum(s['megapixels'] for s in stage_stats):.2f} MPix in {sum(s['seconds'] for s in stage_stats):.2f}s"
+            info += f"\nPeak memory {peak_bytes / 1024 ** 2:.1f} MB"
+            if device_peak is not None:
+                info += f", device {device_peak / 1024 ** 2:.1f} MB"
+        return info + "\n"
+
+    def plan(self, image, upscale_stack, target_width, measure="Off"):
+
+        show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Upscale-Nodes#cr-upscale-stack-planner"
+
+        batch_size, original_height, original_width = image.shape[0], image.shape[1], image.shape[2]
+        target_factor = target_width / original_width
+
+        # Model scales come from the model cache or the file header, so planning does not load the models
+        model_scales = {upscale_model: upscale_model_scale(upscale_model) for upscale_model, rescale_factor in upscale_stack if upscale_model != "None"}
+
+        planned_stack = plan_upscale_stack(upscale_stack, model_scales, original_width, original_height, target_factor)
+        original_costs = estimate_stack_cost(upscale_stack, model_scales, original_width, original_height, batch_size)
+        planned_costs = estimate_stack_cost(planned_stack, model_scales, original_width, original_height, batch_size)
+
+        # Running both stacks gives the actual cost next to each estimate
+        original_measured, planned_measured = None, None
+        if measure == "On":
+            original_measured = self.measure_stack(image, upscale_stack, original_width, original_height)
+            planned_measured = self.measure_stack(image, planned_stack, original_width, original_height)
+
+        plan_info = "Upscale Plan:\n"
+        plan_info += f"Target: {int(original_width * target_factor)}x{int(original_height * target_factor)}\n\n"
+        plan_info += self.stack_info("Original stack", upscale_stack, original_costs, original_measured) + "\n"
+        plan_info += self.stack_info("Planned stack", planned_stack, planned_costs, planned_measured)
+        if measure == "On":
+            plan_info += "Measured with lanczos resampling, supersample true and rounding modulus 8\n"
+
+        return (planned_stack, plan_info, show_help, )
+
 #---------------------------------------------------------------------------------------------------------------------
 class CR_ApplyMultiUpscale:
 
@@ -133,9 +213,15 @@ class CR_ApplyMultiUpscale:
         
         return {"required": {"image": ("IMAGE",),
                              "resampling_method": (resampling_methods,),
-                             "supersample": (["true", "false"],),                     
+                             "supersample": (["true", "false", "legacy"],),                     
                              "rounding_modulus": ("INT", {"default": 8, "min": 8, "max": 1024, "step": 8}),                   
                              "upscale_stack": ("UPSCALE_STACK",),
+                            },
+                "optional": {"max_tile_memory_mb": ("INT", {"default": 0, "min": 0, "max": 1048576, "step": 64}),
+                             "resize_engine": (["pil", "torch"],),
+                             "chunk_size": ("INT", {"default": 0, "min": 0, "max": 10000, "step": 1}),
+                             "cpu_workers": ("INT", {"default": 0, "min": 0, "max": 256, "step": 1}),
+                             "cpu_threads_per_worker": ("INT", {"default": 1, "min": 1, "max": 256, "step": 1}),
                             }
         }
     
@@ -144,42 +230,44 @@ class CR_ApplyMultiUpscale:
     FUNCTION = "apply"
     CATEGORY = icons.get("Comfyroll/Upscale")
 
-    def apply(self, image, resampling_method, supersample, rounding_modulus, upscale_stack):
+    def apply(self, image, resampling_method, supersample, rounding_modulus, upscale_stack, max_tile_memory_mb=0, resize_engine="pil", chunk_size=0, cpu_workers=0, cpu_threads_per_worker=1):
 
         # Get original size
-        pil_img = tensor2pil(image)
-        original_width, original_height = pil_img.size
+        batch_size, original_height, original_width = image.shape[0], image.shape[1], image.shape[2]
     
         # Extend params with upscale-stack items 
         params = list()
         params.extend(upscale_stack)
 
-        # Loop through the list
-        for tup in params:
-            upscale_model, rescale_factor = tup
+        for upscale_model, rescale_factor in params:
             print(f"[Info] CR Apply Multi Upscale: Applying {upscale_model} and rescaling by factor {rescale_factor}")
-            # Load upscale model 
-            up_model = load_model(upscale_model)
 
-            # Upscale with model
-            up_image = upscale_with_model(up_model, image)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        stage_stats = []
 
-            # Get new size
-            pil_img = tensor2pil(up_image)
-            upscaled_width, upscaled_height = pil_img.size
+        # Run the whole batch through each stage in turn
+        if chunk_size == 0 or chunk_size >= batch_size:
+            image, peak_bytes = apply_upscale_stack(image, params, original_width, original_height, resampling_method, supersample, rounding_modulus, max_tile_memory_mb, resize_engine, cpu_workers, cpu_threads_per_worker, stage_stats)
+        # Stream chunks of frames through all stages into a preallocated output
+        else:
+            images_out = None
+            peak_bytes = 0
+            for start in range(0, batch_size, chunk_size):
+                chunk, chunk_peak = apply_upscale_stack(image[start:start + chunk_size], params, original_width, original_height, resampling_method, supersample, rounding_modulus, max_tile_memory_mb, resize_engine, cpu_workers, cpu_threads_per_worker, stage_stats)
+                if images_out is None:
+                    images_out = torch.empty((batch_size,) + tuple(chunk.shape[1:]), dtype=chunk.dtype, device=chunk.device)
+                images_out[start:start + chunk.shape[0]] = chunk
+                peak_bytes = max(peak_bytes, object_nbytes(images_out) + chunk_peak)
+                del chunk
+            image = images_out
 
-            # Return if no rescale needed
-            if upscaled_width == original_width and rescale_factor == 1:
-                image = up_image           
-            else:      
-                # Image resize
-                scaled_images = []
-                mode = "rescale"
-                resize_width = 1024 
-                
-                for img in up_image:
-                    scaled_images.append(pil2tensor(apply_resize_image(tensor2pil(img), original_width, original_height, rounding_modulus, mode, supersample, rescale_factor, resize_width, resampling_method)))
-                image = torch.cat(scaled_images, dim=0)
+        peak_info = f"{peak_bytes / 1024 ** 2:.1f} MB"
+        if torch.cuda.is_available():
+            peak_info += f", device {torch.cuda.max_memory_allocated() / 1024 ** 2:.1f} MB"
+        print(f"[Info] CR Apply Multi Upscale: Peak memory {peak_info}")
+        for (upscale_model, rescale_factor), stats in zip(params, stage_stats):
+            print(f"[Info] CR Apply Multi Upscale: {upscale_model}, actual {stats['megapixels']:.2f} MPix in {stats['seconds']:.2f}s")
             
         show_help = "https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes/wiki/Upscale-Nodes#cr-apply-multi-upscale"
 
@@ -196,6 +284,7 @@ NODE_CLASS_MAPPINGS = {
     "CR Multi Upscale Stack":CR_MultiUpscaleStack,
     "CR Upscale Image":CR_UpscaleImage,
     "CR Apply Multi Upscale":CR_ApplyMultiUpscale,
+    "CR Upscale Stack Planner":CR_UpscaleStackPlanner,
 }
 '''
 
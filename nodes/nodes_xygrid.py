@@ -14,6 +14,8 @@ from pathlib import Path
 import typing as t
 from dataclasses import dataclass
 from .functions_xygrid import create_images_grid_by_columns, Annotation
+from .functions_filename_counter import filename_counters
+from .functions_image_writer import save_reserved_image
 from ..categories import icons
     
 def tensor_to_pillow(image: t.Any) -> Image.Image:
@@ -22,25 +24,20 @@ def tensor_to_pillow(image: t.Any) -> Image.Image:
 def pillow_to_tensor(image: Image.Image) -> t.Any:
     return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
 
+# First number after the prefix in a file name, or None if the name does not have one
+def prefixed_numeric_value(filename, filename_prefix):
+    if not filename.startswith(filename_prefix):
+        return None
+    numeric_match = re.search(r'\d+', filename[len(filename_prefix):])
+    if numeric_match is None:
+        return None
+    return int(numeric_match.group())
+
 def find_highest_numeric_value(directory, filename_prefix):
-    highest_value = -1  # Initialize with a value lower than possible numeric values
-    
-    # Iterate through all files in the directory
-    for filename in os.listdir(directory):
-        if filename.startswith(filename_prefix):
-            try:
-                # Extract numeric part of the filename
-                numeric_part = filename[len(filename_prefix):]
-                numeric_str = re.search(r'\d+', numeric_part).group()
-                numeric_value = int(numeric_str)
-                # Check if the current numeric value is higher than the highest found so far
-                if numeric_value > highest_value:
-                    highest_value = int(numeric_value)
-            except ValueError:
-                # If the numeric part is not a valid integer, ignore the file
-                continue
-    
-    return highest_value
+    # The counter index lists the directory once and keeps the highest value per prefix
+    highest_value = filename_counters.highest(directory, ("xy_grid", filename_prefix),
+                                              lambda filename: prefixed_numeric_value(filename, filename_prefix))
+    return -1 if highest_value is None else highest_value
     
 #---------------------------------------------------------------------------------------------------------------------#
 class CR_XYList:
@@ -331,8 +328,10 @@ class CR_XYSaveGridImage:
 
         print(f"[Info] CR Save XY Grid Image: Output path is `{out_path}`")
         
-        # Set the counter
-        counter = find_highest_numeric_value(out_path, filename_prefix) + 1
+        # Set the counter, reserving the file so concurrent saves get different names
+        counter = filename_counters.reserve(out_path, ("xy_grid", filename_prefix),
+                                            lambda filename: prefixed_numeric_value(filename, filename_prefix),
+                                            lambda c: f"{filename_prefix}_{c:05}.{file_format}", start=0)
         #print(f"[Debug] counter {counter}")
         
         # Output image
@@ -348,7 +347,7 @@ class CR_XYSaveGridImage:
         self.type = "output" if mode == "Save" else 'temp'
 
         resolved_image_path = os.path.join(out_path, f"{output_filename}.{file_format}")
-        img.save(resolved_image_path, **img_params[file_format])
+        save_reserved_image(img, resolved_image_path, img_params[file_format])
         print(f"[Info] CR Save XY Grid Image: Saved to {output_filename}.{file_format}")
         out_filename = f"{output_filename}.{file_format}"
         preview = {"ui": {"images": [{"filename": out_filename,"subfolder": out_path,"type": self.type,}]}}
@@ -0,0 +1,88 @@
+#---------------------------------------------------------------------------------------------------------------------#
+# Comfyroll Studio custom nodes by RockOfFire and Akatsuzi    https://github.com/Suzie1/ComfyUI_Comfyroll_CustomNodes
+# for ComfyUI                                                 https://github.com/comfyanonymous/ComfyUI
+#---------------------------------------------------------------------------------------------------------------------#
+
+#---------------------------------------------------------------------------------------------------------------------#
+# TORCH RESIZE ENGINE TESTS
+#---------------------------------------------------------------------------------------------------------------------#
+# Checks the torch resize engine against PIL's Image.resize. Runs without ComfyUI using the benchmark stubs.
+#
+#   python -m pytest tests
+
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import bench_upscale
+
+# Documented tolerance of the torch engine against PIL, per channel
+TOLERANCE = 2 / 255
+
+RESAMPLE_FILTERS = {'nearest': 0, 'bilinear': 2, 'bicubic': 3, 'lanczos': 1}
+
+# Down, up, non integer, one axis only and a last block of one row
+SIZES = [((256, 192), (100, 75)), ((97, 131), (331, 200)), ((300, 200), (450, 133)), ((128, 128), (128, 301)), ((64, 64), (17, 33))]
+
+@pytest.fixture(scope="module")
+def fu(tmp_path_factory):
+    bench_upscale.install_stubs(str(tmp_path_factory.mktemp("models")))
+    return importlib.import_module(bench_upscale.PACKAGE_NAME + ".nodes.functions_upscale")
+
+def shapes_image(width, height):
+    image = Image.new("RGB", (width, height), (20, 30, 40))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((width // 5, height // 6, width // 2, height // 2), fill=(250, 240, 10))
+    draw.ellipse((width // 3, height // 3, width - 5, height - 7), fill=(5, 200, 250))
+    return image
+
+def noise_image(width, height):
+    rng = np.random.default_rng(width * 1000 + height)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+def to_tensor(image):
+    return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
+
+def pil_resize(image, width, height, resample):
+    return to_tensor(image.resize((width, height), resample=Image.Resampling(RESAMPLE_FILTERS[resample])))
+
+@pytest.mark.parametrize("make_image", [shapes_image, noise_image])
+@pytest.mark.parametrize("resample", ['bilinear', 'bicubic', 'lanczos'])
+@pytest.mark.parametrize("in_size,out_size", SIZES)
+def test_resize_matches_pil(fu, make_image, resample, in_size, out_size):
+    image = make_image(*in_size)
+    resized = torch.clamp(fu.resize_tensor(to_tensor(image), *out_size, resample), min=0, max=1.0)
+    assert (resized - pil_resize(image, *out_size, resample)).abs().max() <= TOLERANCE
+
+def test_nearest_matches_pil_exactly(fu):
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        in_width, in_height, out_width, out_height = (int(size) for size in rng.integers(1, 400, 4))
+        image = noise_image(in_width, in_height)
+        resized = fu.resize_tensor(to_tensor(image), out_width, out_height, 'nearest')
+        assert torch.equal(resized, pil_resize(image, out_width, out_height, 'nearest'))
+
+def test_resample_axis_matches_taps(fu):
+    images = torch.rand(2, 37, 53, 3)
+    indices, weights = fu.resample_weights(53, 120, 'lanczos')
+    expected = (images[:, :, indices] * weights.float().view(1, 1, 120, -1, 1)).sum(dim=3)
+    assert torch.allclose(fu.resample_axis(images, 2, indices, weights), expected, atol=1e-5)
+
+@pytest.mark.parametrize("make_image", [shapes_image, noise_image])
+@pytest.mark.parametrize("resample", ['nearest', 'bilinear', 'bicubic', 'lanczos'])
+@pytest.mark.parametrize("factor", [0.4, 1.5])
+def test_supersample_matches_legacy(fu, monkeypatch, make_image, resample, factor):
+    # Small blocks, so the image is streamed in several
+    monkeypatch.setattr(fu, "SUPERSAMPLE_BLOCK_BYTES", 1024 ** 2)
+    image = make_image(97, 131)
+    supersampled = fu.resize_image_batch(to_tensor(image), 97, 131, 0, 'rescale', 'true', factor, 1024, resample)
+    legacy = fu.resize_image_batch(to_tensor(image), 97, 131, 0, 'rescale', 'legacy', factor, 1024, resample)
+    pil_legacy = to_tensor(fu.apply_resize_image(image, 97, 131, 0, 'rescale', 'legacy', factor, 1024, 1024, resample))
+    assert torch.allclose(supersampled, legacy, atol=1e-5)
+    assert (supersampled - pil_legacy).abs().max() <= TOLERANCE